@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# Copyright (c) 2000-2016 Synology Inc. All rights reserved.
+
+# Measure time and size of compression codecs on a real package.
+#
+# The input is a directory (e.g. the install dir or image/ of a chroot) or an existing tarball.
+# It is turned into a plain tar once, then every codec compresses and decompresses it.
+# Codecs use the spec of include/codec, e.g. "xz:0:0" for PKG_INTERMEDIATE_CODEC.
+
+import sys
+import os
+import argparse
+import json
+import resource
+import subprocess
+import tempfile
+from time import time
+
+ScriptDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(ScriptDir + '/include/python')
+from codec import Codec, CodecError, detect_codec, get_default_codec
+
+DefaultCodecs = "none xz:0:0 xz:0:1 xz:3:1 xz:6:1 zstd:1:0 zstd:3:0 zstd:19:0"
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(func, *args):
+    init_time = time()
+    init_cpu = children_cpu()
+    func(*args)
+    return time() - init_time, children_cpu() - init_cpu
+
+
+def prepare_tar(source, tar_file):
+    if os.path.isdir(source):
+        subprocess.check_call(['tar', '-cf', tar_file, '-C', source, '.'])
+    else:
+        detect_codec(source).decompress(source, tar_file)
+
+
+def bench_codec(codec, tar_file, work_dir, repeat):
+    archive = os.path.join(work_dir, 'bench.archive')
+    output = os.path.join(work_dir, 'bench.tar')
+    compress = []
+    decompress = []
+
+    for _ in range(repeat):
+        compress.append(measure(codec.compress, tar_file, archive))
+        decompress.append(measure(codec.decompress, archive, output))
+
+    result = {
+        'codec': codec.spec,
+        'size': os.path.getsize(archive),
+        'compress': min(compress),
+        'decompress': min(decompress),
+    }
+    os.remove(archive)
+    os.remove(output)
+    return result
+
+
+def format_result(result, input_size, defaults):
+    mb = input_size / 1024.0 / 1024.0
+    compress, compress_cpu = result['compress']
+    decompress, decompress_cpu = result['decompress']
+    return "{:12s} {:>12d} {:>7.3f} {:>10.2f} {:>9.2f} {:>9.1f} {:>10.2f} {:>9.1f}  {}".format(
+        result['codec'], result['size'], result['size'] / float(input_size),
+        compress, compress_cpu, mb / compress if compress else 0,
+        decompress, mb / decompress if decompress else 0,
+        " ".join(kind for kind, codec in defaults.items() if codec.spec == result['codec']))
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser(description='Measure time/size tradeoff of compression codecs.')
+    argparser.add_argument('source', help='Directory or tarball of a package')
+    argparser.add_argument('-c', '--codecs', default=DefaultCodecs,
+                           help='Codec specs to measure, default is "%s"' % DefaultCodecs)
+    argparser.add_argument('-r', '--repeat', type=int, default=1,
+                           help='Repeat each measurement and keep the fastest, default is 1')
+    argparser.add_argument('--json', help='Write results to the file')
+    args = argparser.parse_args(argv)
+
+    codecs = []
+    for spec in args.codecs.split():
+        try:
+            codec = Codec(spec)
+        except CodecError as e:
+            argparser.error(str(e))
+        if not codec.available():
+            print("[WARNING] %s not found, skip %s" % (codec.program, spec))
+            continue
+        codecs.append(codec)
+
+    defaults = dict((kind, get_default_codec(kind)) for kind in ['intermediate', 'package'])
+    work_dir = tempfile.mkdtemp(prefix='codec-bench.')
+    try:
+        tar_file = os.path.join(work_dir, 'input.tar')
+        prepare_tar(args.source, tar_file)
+        input_size = os.path.getsize(tar_file)
+        print("Input: %s, %d bytes tar" % (args.source, input_size))
+
+        results = []
+        for codec in codecs:
+            results.append(bench_codec(codec, tar_file, work_dir, args.repeat))
+    finally:
+        subprocess.call(['rm', '-rf', work_dir])
+
+    print()
+    print("{:12s} {:>12s} {:>7s} {:>10s} {:>9s} {:>9s} {:>10s} {:>9s}  {}".format(
+        'codec', 'size', 'ratio', 'compress', 'cpu', 'MB/s', 'decompress', 'MB/s', 'default for'))
+    for result in results:
+        print(format_result(result, input_size, defaults))
+
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump({'source': args.source, 'input_size': input_size, 'results': results}, fd, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# Copyright (c) 2000-2016 Synology Inc. All rights reserved.
+
+# Measure the orchestration overhead of PkgCreate.
+#
+# A fake toolkit (pkgscripts copy, source/ and build_env/) is generated under a
+# temporary directory. SynoBuild and SynoInstall are replaced by stubs which
+# finish instantly and the chroot step is simulated by changing directory, so
+# the whole PackagePacker pipeline can run unprivileged. What remains is the
+# cost of the tool itself: workers, process pools, linking and log handling.
+
+import sys
+import os
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import importlib.util
+from time import time
+
+ScriptDir = os.path.dirname(os.path.abspath(__file__))
+ScriptName = 'pkgscripts-ng'
+BenchVersion = "6.2"
+BenchBuildNum = "23739"
+BenchPackage = "BenchPkg"
+
+StubBuild = """#!/bin/bash
+# SynoBuild stub for BenchPkgCreate.py
+mkdir -p logs
+for proj in "$@"; do
+	case "$proj" in
+	-*) continue ;;
+	esac
+	echo "Time cost: 00:00:00 [Build-->$proj]" > "logs/$proj.build"
+done
+echo "1 projects, 0 failed."
+"""
+
+StubInstall = """#!/bin/bash
+# SynoInstall stub for BenchPkgCreate.py
+for arg in "$@"; do
+	[ "$arg" = "--with-debug" ] && exit 0
+done
+platform=$(basename "$PWD" | sed 's/^ds\\.//; s/-[^-]*$//')
+version=$(grep '^version=' "source/$PackageName/INFO" | cut -d'"' -f2)
+mkdir -p image/packages
+touch "image/packages/$PackageName-$platform-$version.spk"
+"""
+
+
+class FakeChroot:
+    def __init__(self, path):
+        self.chroot = path
+        self.orig_dir = os.getcwd()
+
+    def __enter__(self):
+        os.chdir(self.chroot)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        os.chdir(self.orig_dir)
+
+    def get_outside_path(self, path):
+        return self.chroot + "/" + path
+
+    def get_inside_path(self, path):
+        return path.replace(self.chroot, "")
+
+
+def write_file(path, content, mode=None):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'w') as fd:
+        fd.write(content)
+
+    if mode:
+        os.chmod(path, mode)
+
+
+def copy_scripts(dest):
+    ignore = shutil.ignore_patterns('.git', '__pycache__', '*.pyc', '*.log', 'requests.jsonl')
+    shutil.copytree(ScriptDir, dest, symlinks=True, ignore=ignore)
+    write_file(os.path.join(dest, 'SynoBuild'), StubBuild, 0o755)
+    write_file(os.path.join(dest, 'SynoInstall'), StubInstall, 0o755)
+
+
+def create_toolkit(root, platform_count, project_count, version_count):
+    toolkit = os.path.join(root, 'toolkit')
+    copy_scripts(os.path.join(toolkit, ScriptName))
+
+    platforms = ['bench%03d' % i for i in range(platform_count)]
+    projects = ['benchlib%03d' % i for i in range(project_count)]
+
+    for proj in projects:
+        write_file(os.path.join(toolkit, 'source', proj, 'Makefile'), "all:\n")
+
+    package_dir = os.path.join(toolkit, 'source', BenchPackage)
+    depends = ["[BuildDependent]"] + projects + ["", "[default]"]
+    depends += ['%s="%s"' % (platform, BenchVersion) for platform in platforms]
+    write_file(os.path.join(package_dir, 'SynoBuildConf', 'depends'), "\n".join(depends) + "\n")
+    write_file(os.path.join(package_dir, 'INFO'),
+               'package="%s"\nversion="1.0.0-0001"\narch="x86_64"\n' % BenchPackage)
+
+    # Platforms are spread over toolkit versions which differ by build number.
+    major, minor = BenchVersion.split('.')
+    for index, platform in enumerate(platforms):
+        build_num = int(BenchBuildNum) + index % version_count
+        chroot = os.path.join(toolkit, 'build_env', 'ds.%s-%s' % (platform, BenchVersion))
+        write_file(os.path.join(chroot, 'PkgVersion'),
+                   'majorversion="%s"\nminorversion="%s"\nbuildnumber="%d"\n' % (major, minor, build_num))
+
+    return toolkit
+
+
+def run_trial(toolkit, result_file, pkgcreate_args):
+    script_dir = os.path.join(toolkit, ScriptName)
+    spec = importlib.util.spec_from_file_location('PkgCreate', os.path.join(script_dir, 'PkgCreate.py'))
+    pkgcreate = importlib.util.module_from_spec(spec)
+    sys.modules['PkgCreate'] = pkgcreate
+    spec.loader.exec_module(pkgcreate)
+
+    # Simulate chroot: commands are run relative to the chroot directory.
+    pkgcreate.Chroot = FakeChroot
+    pkgcreate.PkgScripts = ScriptName
+
+    args = pkgcreate.args_parser(pkgcreate_args + [BenchPackage])
+    if args.profile:
+        pkgcreate.profiler.enable(os.path.join(toolkit, 'pkgcreate.profile'))
+    init_time = time()
+    packer = pkgcreate.create_packer(args)
+    packer.pack_package()
+    total = time() - init_time
+
+    with open(result_file, 'w') as fd:
+        json.dump({'stages': packer.get_time_records(), 'total': total}, fd)
+
+
+def run_bench(platform_count, project_count, version_count, pkgcreate_args, keep):
+    root = tempfile.mkdtemp(prefix='pkgcreate-bench.')
+    try:
+        toolkit = create_toolkit(root, platform_count, project_count, version_count)
+        result_file = os.path.join(root, 'result.json')
+        cmd = [sys.executable, os.path.abspath(__file__), '--trial', toolkit, result_file, '--'] + pkgcreate_args
+        with open(os.devnull, 'wb') as null:
+            ret = subprocess.call(cmd, stdout=null, stderr=subprocess.STDOUT)
+        if ret != 0:
+            raise RuntimeError("Trial failed, see %s" % os.path.join(toolkit, 'pkgcreate.log'))
+
+        with open(result_file, 'r') as fd:
+            return json.load(fd)
+    finally:
+        if keep:
+            print("Keep bench directory: " + root)
+        else:
+            shutil.rmtree(root)
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def show_report(rows, stages):
+    header = ["platforms", "projects"] + stages + ["total", "per platform"]
+    widths = [max(len(_), 9) for _ in header]
+    print("  ".join(title.rjust(width) for title, width in zip(header, widths)))
+    for row in rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+
+def parse_args(argv):
+    argparser = argparse.ArgumentParser(description='Measure PkgCreate orchestration overhead with stub builds.')
+    argparser.add_argument('-p', '--platforms', default="1 4 16",
+                           help='Platform counts to measure, default is "1 4 16"')
+    argparser.add_argument('-n', '--projects', default="1 10",
+                           help='Dependency project counts to measure, default is "1 10"')
+    argparser.add_argument('-v', '--versions', type=int, default=1,
+                           help='Number of toolkit versions the platforms are spread over, default is 1')
+    argparser.add_argument('-r', '--repeat', type=int, default=3, help='Repeat each measurement, default is 3')
+    argparser.add_argument('-k', '--keep', action='store_true', help='Keep generated toolkit for inspection')
+    argparser.add_argument('--pkgcreate-opt', default="-x 0 -c -S",
+                           help='Arguments pass to PkgCreate, default is "-x 0 -c -S"')
+    return argparser.parse_args(argv)
+
+
+def main(argv):
+    if argv and argv[0] == '--trial':
+        run_trial(argv[1], argv[2], argv[4:])
+        return
+
+    args = parse_args(argv)
+    pkgcreate_args = args.pkgcreate_opt.split()
+    stages = []
+    rows = []
+
+    for platform_count in map(int, args.platforms.split()):
+        for project_count in map(int, args.projects.split()):
+            results = [run_bench(platform_count, project_count, args.versions, pkgcreate_args, args.keep)
+                       for _ in range(args.repeat)]
+
+            stage_times = {}
+            for result in results:
+                # Workers sharing a title (e.g. debug and release install) are summed.
+                trial_times = {}
+                for title, elapsed in result['stages']:
+                    if title not in stages:
+                        stages.append(title)
+                    trial_times[title] = trial_times.get(title, 0) + elapsed
+                for title, elapsed in trial_times.items():
+                    stage_times.setdefault(title, []).append(elapsed)
+
+            total = median([_['total'] for _ in results])
+            row = [platform_count, project_count]
+            row += ["%.3f" % median(stage_times[_]) if _ in stage_times else "-" for _ in stages]
+            row += ["%.3f" % total, "%.3f" % (total / platform_count)]
+            rows.append(row)
+            print("[%d platforms, %d projects] total %.3fs" % (platform_count, project_count, total))
+
+    print()
+    show_report(rows, stages)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
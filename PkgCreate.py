@@ -7,32 +7,69 @@ from subprocess import check_call, check_output, CalledProcessError, STDOUT, Pop
 import argparse
 import glob
 import shutil
+import hashlib
+import multiprocessing
+import re
+import shlex
 from time import localtime, strftime, gmtime, time
 from collections import defaultdict
+from functools import partial
 
 # Paths
 ScriptDir = os.path.dirname(os.path.abspath(__file__))
 BaseDir = os.path.dirname(ScriptDir)
 ScriptName = os.path.basename(__file__)
 PkgScripts = '/pkgscripts-ng'
+PrebuiltDir = 'prebuilt'
 
 sys.path.append(ScriptDir+'/include')
 sys.path.append(ScriptDir+'/include/python')
 import BuildEnv
 from chroot import Chroot
-from parallel import doPlatformParallel, doParallel
-from link_project import link_projects, link_scripts, LinkProjectError
+from parallel import doPlatformParallel, doAdmittedPlatformParallel, doParallel, doThreadParallel, setFailFast, \
+    setPoolSize, ParallelCancelledError
+from link_project import link_projects, link_scripts, relink_path, LinkProjectError
 from tee import Tee
 import config_parser
 from project_visitor import UpdateHook, ProjectVisitor, UpdateFailedError, ConflictError
+from git_update import GitUpdateHook
 from version_file import VersionFile
+import ProjectDepends
+from resource_usage import format_usage, format_size
+from file_watcher import new_watcher
+import profiler
+from executor import new_executor, parse_hosts, LocalHost, ExecutorError
+from journal import RunJournal, fingerprint, get_source_revision
+from reproducible import get_source_date_epoch, digest_archive, diff_digests
+from prebuilt_cache import PrebuiltCache
+from watchdog import TimeoutPolicy
+from memory_admission import MemoryAdmission, MemoryHighPolicy, MemoryCgroupError, setup_memory_cgroup
+from tarball_store import TarballStoreError
+from metrics import Metrics, usage_families, read_ccache_stats
+from timing_db import TimingDatabase, parse_time_cost, critical_path_order, lpt_order, predict_makespan
 
 log_file = os.path.join(BaseDir, 'pkgcreate.log')
+timing_db_file = os.path.join(BaseDir, 'pkgcreate.timing.db')
+journal_file = os.path.join(BaseDir, 'pkgcreate.journal')
 sys.stdout = Tee(sys.stdout, log_file)
 sys.stderr = Tee(sys.stderr, log_file, move=False)
 
 MinSDKVersion = "6.0"
 BasicProjects = set()
+# git processes run at once by per project checks
+GitJobs = multiprocessing.cpu_count() * 2
+
+MetricFamilies = dict({
+    'worker_duration_seconds': 'Wall time of a worker',
+    'stage_duration_seconds': 'Wall time of a stage on a platform',
+    'stage_resumed': 'Stage on a platform skipped since a previous run has done it',
+    'stage_failed_projects': 'Failed projects of a stage on a platform',
+    'stage_log_bytes': 'Size of logs written by a stage, log="projects" sums logs/<project>.<type>',
+    'projects': 'Build projects of a platform by state: built, prebuilt, failed or skipped',
+    'ccache_hits': 'Ccache hits of a build by kind: direct or preprocessed',
+    'ccache_misses': 'Ccache misses of a build',
+    'ccache_hit_ratio': 'Ccache hits of all cacheable compilations of a build',
+}, **usage_families('stage', 'a stage on a platform'))
 
 
 class PkgCreateError(RuntimeError):
@@ -100,11 +137,71 @@ def args_parser(argv):
     argparser.add_argument('-I', dest='install', action='store_false', help='Not install projects.')
     argparser.add_argument('-i', dest='only_install', action='store_true', help='Only install projects.')
     argparser.add_argument('-S', dest="sign", action='store_false', help='Do not make code sign.')
+    argparser.add_argument('--git-remote',
+                           help='Update projects from git remote, "{project}" is replaced by project name, '
+                                'otherwise <remote>/<project>.git is used.')
+    argparser.add_argument('--git-mirror', default=os.path.join(BaseDir, 'git_mirror'),
+                           help='Local bare mirror cache of --git-remote, default is git_mirror/')
+    argparser.add_argument('--git-tag', default='{build_num}',
+                           help='Tag checked out for tag projects, default is "{build_num}" of toolkit version.')
+    argparser.add_argument('--hosts',
+                           help='Build platforms on worker hosts over ssh, e.g. "root@host1:4 root@host2:2 local:2", '
+                                'the number is how many platforms the host builds at the same time.')
+    argparser.add_argument('--remote-base', help='Toolkit dir on worker hosts, default is the same as local.')
     argparser.add_argument('--build-opt', default="", help='Argument pass to SynoBuild')
     argparser.add_argument('--install-opt', default="", help='Argument pass to SynoInstall')
     argparser.add_argument('--print-log', action='store_true', help='Print SynoBuild/SynoInstall error log.')
+    argparser.add_argument('--fail-fast', action='store_true',
+                           help='Cancel all platforms once one of them failed.')
+    argparser.add_argument('--dedup', action='store_true',
+                           help='Build once for platforms with identical toolchain or noarch package.')
+    argparser.add_argument('--sample-interval', type=float, default=1.0,
+                           help='Seconds between resource samples of build/install processes, 0 to disable.')
+    argparser.add_argument('--changed', metavar='REV_RANGE',
+                           help='Only build and install projects changed in git REV_RANGE and their reverse depends.')
+    argparser.add_argument('--plan', action='store_true',
+                           help='Print predicted build order and makespan from timing history, build nothing.')
+    argparser.add_argument('--resume', action='store_true',
+                           help='Record platform stages into pkgcreate.journal and skip those done by previous '
+                                '--resume runs with the same arguments, sources and toolkit.')
+    argparser.add_argument('--watch', action='store_true',
+                           help='After packing, rebuild changed projects and their reverse depends without cleaning '
+                                'and reinstall on every change of the sources, until Ctrl-C.')
+    argparser.add_argument('--timeout-factor', type=float, default=4.0,
+                           help='Kill a project or a stage running longer than this times its average duration '
+                                'of previous runs, 0 to disable. A build stage is bound by the sum of its projects, '
+                                'no limit if one of them has no history. Default is 4.')
+    argparser.add_argument('--min-timeout', type=int, default=1800,
+                           help='Timeouts from previous durations are at least this many seconds, default is 1800.')
+    argparser.add_argument('--project-timeout', type=int, help='Timeout in seconds of every project.')
+    argparser.add_argument('--stage-timeout', type=int, help='Timeout in seconds of SynoBuild/SynoInstall.')
+    argparser.add_argument('--memory-limit', type=float,
+                           help='Start platforms only while their expected peak RSS fits in this many GB, 0 is '
+                                'MemAvailable at start. Expected peak RSS is the worst of previous runs, a build '
+                                'expects its biggest project.')
+    argparser.add_argument('--default-memory', type=float, default=1.0,
+                           help='Expected peak RSS in GB of a project or stage without history, default is 1.')
+    argparser.add_argument('--memory-high', type=float, metavar='FACTOR',
+                           help='Run SynoBuild/SynoInstall of each platform in a cgroup v2 with memory.high of '
+                                'FACTOR times its expected peak RSS.')
+    argparser.add_argument('--prebuilt-cache', metavar='DIR',
+                           help='Cache install-dev output of build projects pinned at a tag in DIR, SynoBuild '
+                                'stages cached output into the sysroot instead of building them.')
+    argparser.add_argument('--prebuilt-cache-size', type=float, default=0,
+                           help='Evict least recently used output when the cache exceeds this size in GB')
+    argparser.add_argument('--reproducible', action='store_true',
+                           help='Build with SOURCE_DATE_EPOCH (commit time of the packages if not set) and '
+                                'normalized tarballs, the same sources give byte-identical spks.')
+    argparser.add_argument('--verify-reproducible', dest='verify', action='store_true',
+                           help='Pack twice in reproducible mode and report spks and members which differ.')
+    argparser.add_argument('--profile', action='store_true',
+                           help='Profile main process and pool tasks into pkgcreate.profile next to the log.')
+    argparser.add_argument('--metrics-file',
+                           help='Write OpenMetrics of the run into the file at the end, e.g. into the textfile '
+                                'collector dir of node_exporter.')
     argparser.add_argument('--min-sdk', dest='sdk_ver', default=MinSDKVersion, help='Min sdk version, default=6.0')
-    argparser.add_argument('package', help='Target packages')
+    argparser.add_argument('package', nargs='+',
+                           help='Target packages, projects of all packages are traversed, linked and built once.')
 
     args = argparser.parse_args(argv)
     if not args.build:
@@ -113,6 +210,18 @@ def args_parser(argv):
     if args.only_install:
         args.update = args.link = args.build = False
 
+    # --plan builds nothing, sources in SourceDir are left as they are
+    if args.plan:
+        args.update = args.link = False
+
+    if args.verify:
+        if args.watch or args.plan:
+            argparser.error("--verify-reproducible can not be used with --watch or --plan")
+        # both runs must build everything, otherwise the second one reuses results of the first
+        if args.resume or args.prebuilt_cache or args.changed or args.only_install:
+            argparser.error("--verify-reproducible can not be used with --resume, --prebuilt-cache, --changed or -i")
+        args.reproducible = args.collect = True
+
     if args.platforms:
         args.platforms = args.platforms.split()
 
@@ -131,20 +240,42 @@ def args_parser(argv):
 
 class WorkerFactory:
     def __init__(self, args):
-        self.package = Package(args.package)
         self.env_config = EnvConfig(args.package, args.env_section, args.env_version, args.platforms, args.dep_level,
                                     args.branch, args.suffix)
-        self.package.chroot = self.env_config.get_chroot()
+        self.packages = []
+        for name in args.package:
+            package = Package(name)
+            package.platforms = self.env_config.package_platforms[name]
+            if not package.platforms:
+                raise PkgCreateError("No platform found for %s!" % name)
+            package.chroot = self.env_config.get_chroot(sorted(package.platforms)[0])
+            self.packages.append(package)
+
+        if len(self.packages) == 1:
+            self.package = self.packages[0]
+        else:
+            self.package = PackageBatch(self.packages)
 
     def new(self, worker_class, *args, **kwargs):
         return worker_class(self.package, self.env_config, *args, **kwargs)
 
+    # worker of a single package in batch, its title tells the package apart
+    def new_package(self, package, worker_class, *args, **kwargs):
+        worker = worker_class(package, self.env_config, *args, **kwargs)
+        if package is not self.package:
+            worker.title = "%s [%s]" % (worker.title, package.name)
+
+        return worker
+
 
 class Worker:
     def __init__(self, package, env_config):
         self.package = package
         self.env_config = env_config
         self.__time_log = None
+        self.elapsed = None
+        self.resource_usage = None
+        self.counters = None
 
     def execute(self, *argv):
         if not self._check_executable():
@@ -155,8 +286,17 @@ class Worker:
             print("\n" + "=" * 60)
             print("{:^60s}".format('Start to run "%s"' % self.title))
             print("-" * 60)
-        self._process_output(self._run(*argv))
-        self.__time_log = strftime('%H:%M:%S', gmtime(time()-init_time))
+        try:
+            output = self._run(*argv)
+        except ParallelCancelledError as e:
+            show_msg_block(e.summary(), title="Cancelled by fail-fast", error=True)
+            if isinstance(e.error, PkgCreateError):
+                raise e.error
+            raise PkgCreateError(str(e.error))
+
+        self._process_output(output)
+        self.elapsed = time() - init_time
+        self.__time_log = strftime('%H:%M:%S', gmtime(self.elapsed))
 
     def _run(self):
         pass
@@ -167,6 +307,18 @@ class Worker:
     def _process_output(self, output):
         pass
 
+    # Run the work of a single platform, used by PlatformPipeline.
+    def run_platform(self, platform):
+        raise PkgCreateError("Not implement")
+
+    # Store durations finer than the stage of a finished platform.
+    def record_timing(self, db, platform):
+        pass
+
+    # Expected peak RSS of the work on a platform, only commands in chroot take memory worth counting.
+    def get_peak_rss(self, db, platform, default):
+        return 0
+
     def get_time_cost(self):
         time_cost = []
         if hasattr(self, 'title') and self.__time_log:
@@ -174,25 +326,54 @@ class Worker:
 
         return time_cost
 
+    def get_time_records(self):
+        if hasattr(self, 'title') and self.elapsed is not None:
+            return [(self.title, self.elapsed)]
+
+        return []
+
+    def add_metrics(self, metrics):
+        for title, elapsed in self.get_time_records():
+            metrics.add('worker_duration_seconds', elapsed, worker=title)
+
+    # Metrics of a stage on a platform, failed_projs and counters are None if the stage was resumed.
+    def add_platform_metrics(self, metrics, platform, failed_projs, counters):
+        pass
+
 
 class EnvPrepareWorker(Worker):
-    def __init__(self, package, env_config, update):
+    def __init__(self, package, env_config, update, git_remote=None, git_mirror=None, git_tag='{build_num}'):
         Worker.__init__(self, package, env_config)
         self.update = update
+        self.git_remote = git_remote
+        self.git_mirror = git_mirror
+        self.git_tag = git_tag
         self.sub_workers = []
 
+    def _new_update_hook(self, build_num):
+        if self.git_remote:
+            return GitUpdateHook(self.git_remote, self.git_mirror, self.env_config.branch, build_num, self.git_tag)
+
+        return UpdateHook(self.env_config.branch, build_num)
+
     def _run(self, *argv):
         depends_cache = None
-        update_hook = None
+        checkouts = defaultdict(dict)
         for version, platforms in self.env_config.toolkit_versions.items():
             print("Processing [%s]: " % version + " ".join(platforms))
             dsm_ver, build_num = version.split('-')
 
+            update_hook = None
             if self.update:
-                update_hook = UpdateHook(self.env_config.branch, build_num)
+                update_hook = self._new_update_hook(build_num)
 
+            checkout_key = update_hook.checkout_key if update_hook else None
+            checkouts[checkout_key][version] = update_hook
+
+        # Versions sharing one source checkout are prepared together, different checkouts take turns on SourceDir.
+        for update_hooks in checkouts.values():
             for worker in self.sub_workers:
-                worker.execute(version, update_hook, depends_cache)
+                worker.execute(update_hooks, depends_cache)
 
     def add_subworker(self, sub_worker):
         self.sub_workers.append(sub_worker)
@@ -205,17 +386,41 @@ class EnvPrepareWorker(Worker):
 
         return time_cost
 
+    def get_time_records(self):
+        records = []
+        for sub_worker in self.sub_workers:
+            records += sub_worker.get_time_records()
+
+        return records
+
 
 class ProjectTraverser(Worker):
     title = "Traverse project"
 
-    def _run(self, version, update_hook, cache):
+    def _run(self, update_hooks, cache):
         dep_level = self.env_config.dep_level
-        platforms = self.env_config.toolkit_versions[version]
 
+        # Platforms with identical dependency resolution and packages share one traversal.
+        groups = defaultdict(list)
+        for version, update_hook in update_hooks.items():
+            roots = defaultdict(list)
+            for platform in self.env_config.toolkit_versions[version]:
+                roots[tuple(self.package.get_roots(platform))].append(platform)
+
+            for root_projs, platforms in roots.items():
+                visitor = ProjectVisitor(update_hook, dep_level, platforms, depends_cache=cache)
+                groups[(root_projs, visitor.resolve_key)].append((platforms, visitor))
+
+        results = doThreadParallel(self._traverse, [(key[0], group[0][1]) for key, group in groups.items()])
+
+        for group, dict_projects in zip(groups.values(), results):
+            for platforms, visitor in group:
+                self.package.set_projects(platforms, dict_projects)
+
+    def _traverse(self, task):
+        root_projs, visitor = task
         try:
-            visitor = ProjectVisitor(update_hook, dep_level, platforms, depends_cache=cache)
-            dict_projects = visitor.traverse(self.package.name)
+            dict_projects = visitor.traverse(list(root_projs))
             visitor.checkout_git_refs()
             visitor.show_proj_info()
         except UpdateFailedError as e:
@@ -226,22 +431,74 @@ class ProjectTraverser(Worker):
         except ConflictError as e:
             raise TraverseProjectError(str(e))
 
-        self.package.dict_projects = dict_projects
+        return dict_projects
+
+
+# Fingerprint of each platform is taken while its checkout is in SourceDir, stages done with the same
+# fingerprint are loaded from the journal. Only added on --resume, fingerprinting walks all sources.
+class JournalChecker(Worker):
+    title = "Check journal"
+
+    # arguments which change the result of a stage
+    __args__ = ['package', 'env_section', 'env_version', 'dep_level', 'branch', 'suffix', 'sdk_ver',
+                'build_opt', 'install_opt', 'sign', 'collect', 'dedup', 'git_remote', 'git_tag', 'reproducible']
+
+    def __init__(self, package, env_config, args):
+        Worker.__init__(self, package, env_config)
+        self.args = dict((_, getattr(args, _)) for _ in self.__args__)
+
+    def _run(self, update_hooks, *argv):
+        platforms = []
+        for version in update_hooks:
+            platforms += [(_, version) for _ in self.env_config.toolkit_versions[version]]
+
+        projects = set([os.path.basename(ScriptDir)])
+        for platform, _ in platforms:
+            projects |= self.__get_projects(platform)
+        projects = sorted(projects)
+        revisions = dict(zip(projects, doThreadParallel(self.__get_revision, projects, GitJobs)))
+
+        fingerprints = dict()
+        for platform, version in platforms:
+            fingerprints[platform] = fingerprint(self.args, version, sorted(
+                (_, revisions[_]) for _ in self.__get_projects(platform) | set([os.path.basename(ScriptDir)])))
+        self.env_config.set_platform_fingerprints(fingerprints)
+
+        done = self.env_config.journal.get_done_stages(fingerprints)
+        self.env_config.set_done_stages(done)
+        show_msg_block(["[%s] %s" % (_, ", ".join(sorted(done[_]))) for _ in sorted(done)] or
+                       ["No stage to resume."], title="Resume stages done by previous run")
+
+    def __get_projects(self, platform):
+        return set(map(BuildEnv.deVirtual, self.package.get_build_projects(platform) |
+                       self.package.get_ref_projects(platform)))
+
+    def __get_revision(self, proj):
+        if proj == os.path.basename(ScriptDir):
+            return get_source_revision(ScriptDir)
+
+        return get_source_revision(os.path.join(BuildEnv.SourceDir, proj))
 
 
 class ProjectLinker(Worker):
     title = "Link Project"
 
-    def _run(self, version, *argv):
+    def _run(self, update_hooks, *argv):
         tasks = []
-        for platform in self.env_config.toolkit_versions[version]:
-            chroot = self.env_config.get_chroot(platform)
-            if not os.path.isdir(os.path.join(chroot, 'source')):
-                os.makedirs(os.path.join(chroot, 'source'))
-            link_scripts(chroot)
-            tasks.append((set(BasicProjects) |
-                          self.package.get_build_projects(platform) |
-                          self.package.ref_projs, chroot))
+        for version in update_hooks:
+            for platform in self.env_config.toolkit_versions[version]:
+                # relinking removes the build output later stages of a resumed platform need
+                if PackageBuilder.title in self.env_config.done_stages.get(platform, set()):
+                    print("[%s] Skip linking, build is resumed." % platform)
+                    continue
+
+                chroot = self.env_config.get_chroot(platform)
+                if not os.path.isdir(os.path.join(chroot, 'source')):
+                    os.makedirs(os.path.join(chroot, 'source'))
+                link_scripts(chroot)
+                tasks.append((set(BasicProjects) |
+                              self.package.get_build_projects(platform) |
+                              self.package.get_ref_projects(platform), chroot))
 
         try:
             doParallel(link_projects, tasks)
@@ -249,45 +506,396 @@ class ProjectLinker(Worker):
             raise LinkPackageError(str(e))
 
 
+# Platforms producing the same spk (noarch package, or same unified platform and toolchain)
+# are built once by a representative and the result is copied to the others.
+class PlatformDeduplicator(Worker):
+    title = "Group platforms"
+
+    def _run(self):
+        classes = defaultdict(list)
+        for platform in sorted(self.env_config.platforms):
+            # packages of a batch installed on a platform must be the same for the whole class
+            classes[(tuple(self.package.get_roots(platform)),) + self._get_platform_class(platform)].append(platform)
+
+        msg = []
+        members = dict()
+        for platforms in classes.values():
+            members[platforms[0]] = platforms[1:]
+            if len(platforms) > 1:
+                msg.append("[%s] builds for: %s" % (platforms[0], " ".join(platforms[1:])))
+
+        self.env_config.set_platform_members(members)
+        show_msg_block(msg or ["No identical platforms found."], title="Deduplicated platforms")
+
+    # spks of different toolkit versions target different DSM versions
+    def _get_platform_class(self, platform):
+        version = self.env_config.get_toolkit_version(platform)
+        if self.package.is_noarch:
+            return ('noarch', version)
+
+        chroot = self.env_config.get_chroot(platform)
+        env_mak = os.path.join(chroot, 'env32.mak')
+        if not os.path.isfile(env_mak):
+            # env.mak is generated by the first SynoBuild, unknown toolchain can not be shared
+            return (platform,)
+
+        try:
+            unified, family = check_output('source %s/include/pkg_util.sh && pkg_get_spk_unified_platform %s && '
+                                           'plat_to_family $(pkg_get_platform %s)' % (ScriptDir, env_mak, env_mak),
+                                           shell=True, executable='/bin/bash', stderr=STDOUT).decode().split()
+        except (CalledProcessError, ValueError):
+            return (platform,)
+
+        return (unified, family, version, self._get_toolchain_digest(chroot))
+
+    def _get_toolchain_digest(self, chroot):
+        digest = hashlib.sha1()
+        for env_mak in ['env32.mak', 'env64.mak']:
+            env_mak = os.path.join(chroot, env_mak)
+            if not os.path.isfile(env_mak):
+                continue
+
+            with open(env_mak, 'r') as fd:
+                content = fd.read()
+
+            # platform identity differs by definition, everything else must be equal
+            for var in ['PLATFORM_ABBR', 'SYNO_PLATFORM']:
+                match = re.search('^%s=(.*)$' % var, content, re.M)
+                if match and match.group(1):
+                    content = content.replace(match.group(1), '@%s@' % var)
+            digest.update(content.encode())
+
+        toolchain_dir = os.path.join(chroot, 'usr', 'local')
+        if os.path.isdir(toolchain_dir):
+            digest.update(" ".join(sorted(os.listdir(toolchain_dir))).encode())
+
+        return digest.hexdigest()
+
+
+# Only projects with changes in the git revision range and the projects depending on them are built,
+# on the platforms which build any of them.
+class AffectedProjectSelector(Worker):
+    title = "Select affected projects"
+
+    def __init__(self, package, env_config, rev_range):
+        Worker.__init__(self, package, env_config)
+        self.rev_range = rev_range
+
+    def _run(self):
+        projects = set()
+        for platform in self.env_config.build_platforms:
+            projects |= self.package.get_build_projects(platform)
+        projects = sorted(projects)
+
+        changed = set()
+        for proj, files in zip(projects, doThreadParallel(self._get_changed_files, projects, GitJobs)):
+            if files is None or any(is_project_affected(proj, _) for _ in files):
+                changed.add(proj)
+
+        affected = set(get_reverse_depends(changed)) & set(projects) if changed else set()
+        platforms = set(_ for _ in self.env_config.build_platforms if self.package.get_build_projects(_) & affected)
+        self.package.set_affected_projects(affected)
+        self.env_config.set_affected_platforms(platforms)
+
+        show_msg_block(["Changed   : " + " ".join(sorted(changed)),
+                        "Affected  : " + " ".join(sorted(affected)),
+                        "Platforms : " + " ".join(sorted(platforms))], title="Affected by " + self.rev_range)
+
+    # None if changes can not be determined, the project is rebuilt then
+    def _get_changed_files(self, proj):
+        proj_dir = os.path.join(BuildEnv.SourceDir, BuildEnv.deVirtual(proj))
+        try:
+            with open(os.devnull, 'wb') as null:
+                output = check_output(['git', '-C', proj_dir, 'diff', '--name-only', '--relative', self.rev_range],
+                                      stderr=null).decode()
+        except (CalledProcessError, OSError):
+            print("[WARNING] Unable to diff %s in %s, rebuild it." % (self.rev_range, proj_dir))
+            return None
+
+        return output.split()
+
+
+# Changed files are watched in the project sources after the first build. Touched projects and their
+# reverse depends are relinked file by file and rebuilt without cleaning, then packages are reinstalled.
+class ProjectWatcher(Worker):
+    title = "Watch projects"
+
+    def __init__(self, package, env_config, pipeline, workers, link=True):
+        Worker.__init__(self, package, env_config)
+        self.pipeline = pipeline
+        self.workers = workers
+        self.link = link
+
+    def _run(self):
+        self.package.set_affected_projects(None)
+        self.env_config.set_affected_platforms(None)
+        self.env_config.done_stages.clear()
+        projects = self.__get_projects()
+        for stage in self.pipeline.stages:
+            if isinstance(stage, PackageBuilder):
+                stage.clean = False
+        # incremental builds are no history for scheduling, nor results of the checkout fingerprinted at start
+        self.pipeline.record = False
+
+        source_dirs = sorted(set(os.path.join(BuildEnv.SourceDir, BuildEnv.deVirtual(_)) for _ in projects))
+        watcher = new_watcher(source_dirs)
+        print("Watching %d projects for changes, press Ctrl-C to stop." % len(source_dirs))
+        try:
+            while True:
+                changed = watcher.wait()
+                touched = self.__get_touched_projects(projects, changed)
+                if touched:
+                    self.__rebuild(projects, touched, changed)
+        except KeyboardInterrupt:
+            print("\nStop watching.")
+        finally:
+            watcher.close()
+
+    def __get_projects(self):
+        projects = set()
+        for platform in self.env_config.target_platforms:
+            projects |= self.package.get_build_projects(platform)
+
+        return projects
+
+    def __get_touched_projects(self, projects, changed):
+        touched = set()
+        for path in changed:
+            rel_path = os.path.relpath(path, BuildEnv.SourceDir)
+            proj_dir, _, changed_file = rel_path.partition('/')
+            touched.update(_ for _ in projects
+                           if BuildEnv.deVirtual(_) == proj_dir and is_project_affected(_, changed_file))
+
+        return touched
+
+    def __rebuild(self, projects, touched, changed):
+        try:
+            affected = set(get_reverse_depends(touched)) & projects
+        except PkgCreateError as e:
+            show_msg_block([str(e)], title=type(e).__name__, error=True)
+            return
+
+        self.package.set_affected_projects(affected)
+        self.env_config.set_affected_platforms(
+            _ for _ in self.env_config.build_platforms if self.package.get_build_projects(_))
+        show_msg_block(["Touched   : " + " ".join(sorted(touched)),
+                        "Rebuild   : " + " ".join(sorted(affected))], title="Changes found")
+
+        init_time = time()
+        try:
+            if self.link:
+                self.__relink(touched, changed)
+            for worker in self.workers:
+                worker.execute()
+        except PkgCreateError as e:
+            show_msg_block([str(e)], title=type(e).__name__, error=True)
+            return
+        finally:
+            for worker in self.workers:
+                for line in worker.get_time_cost():
+                    print(line)
+
+        print("[SUCCESS] Rebuilt in %s, waiting for changes." % format_duration(time() - init_time))
+
+    def __relink(self, touched, changed):
+        for platform in self.env_config.target_platforms:
+            chroot = self.env_config.get_chroot(platform)
+            linked = touched & (self.package.get_build_projects(platform) | self.package.get_ref_projects(platform))
+            for path in changed:
+                proj_dir, _, changed_file = os.path.relpath(path, BuildEnv.SourceDir).partition('/')
+                for proj in linked:
+                    if BuildEnv.deVirtual(proj) == proj_dir:
+                        try:
+                            relink_path(path, os.path.join(chroot, 'source', proj, changed_file))
+                        except OSError as e:
+                            raise LinkPackageError("[%s] Failed to relink %s: %s" % (platform, path, str(e)))
+
+
+# SynoBuildConf/*-virtual-<name> only belongs to the virtual project <name>
+def is_project_affected(proj, changed_file):
+    if not changed_file.startswith(BuildEnv.ConfDir + '/'):
+        return True
+
+    return BuildEnv.getVirtualName(os.path.basename(changed_file)) == BuildEnv.getVirtualName(proj)
+
+
+def load_build_depends(projects):
+    depends = dict()
+    for proj in projects:
+        try:
+            parser = config_parser.DependsParser(BuildEnv.Project(proj).depends_script)
+            depends[proj] = parser.build_dep + parser.build_tag
+        except config_parser.ConfigNotFoundError:
+            depends[proj] = []
+
+    return depends
+
+
+def get_reverse_depends(projects):
+    config = config_parser.ProjectDependsParser(ProjectDepends.config_path)
+    dict_depends = ProjectDepends.loadConfigFiles(config)
+    ProjectDepends.replaceVariableSection(config, dict_depends)
+    try:
+        return ProjectDepends.DepGraph(dict_depends, 0, 'backwardDependency').traverseDepends(sorted(projects))
+    except ProjectDepends.DependencyError as e:
+        raise PkgCreateError(str(e))
+
+
+# Longest platforms are started first and projects on the critical path are passed to SynoBuild first,
+# according to the durations recorded by previous runs.
+class BuildScheduler(Worker):
+    title = "Schedule build"
+
+    def __init__(self, package, env_config, pipeline, plan=False, default_memory=0):
+        Worker.__init__(self, package, env_config)
+        self.pipeline = pipeline
+        self.plan = plan
+        self.default_memory = default_memory
+
+    def _run(self):
+        durations = dict()
+        orders = dict()
+        memory = dict()
+
+        with TimingDatabase(timing_db_file) as db:
+            for platform in sorted(self.env_config.target_platforms):
+                projects = self.package.get_build_projects(platform)
+                project_times = dict((proj, db.get_project_time(platform, proj)) for proj in projects)
+                orders[platform] = critical_path_order(projects, self._get_depends(projects), project_times)
+                self.package.set_build_order(platform, orders[platform])
+
+                stage_times = [db.get_stage_time(self.package.name, platform, stage.title)
+                               for stage in self.pipeline.stages]
+                stage_times = [_ for _ in stage_times if _ is not None]
+                durations[platform] = sum(stage_times) if stage_times else None
+
+                # stages of a platform run one after another
+                memory[platform] = max([stage.get_peak_rss(db, platform, self.default_memory)
+                                        for stage in self.pipeline.stages
+                                        if platform in stage.package.platforms] + [0])
+
+        self.env_config.set_platform_durations(durations)
+        self.env_config.set_platform_memory(memory)
+
+        if self.plan:
+            workers = multiprocessing.cpu_count()
+            msg = []
+            for platform in lpt_order(durations):
+                msg.append("[%s] %s, %s: %s" % (platform, format_duration(durations[platform]),
+                                                format_size(memory[platform]), " ".join(orders[platform])))
+            msg.append("")
+            msg.append("Predicted makespan: %s (parallel workers: %d)" % (
+                format_duration(predict_makespan(durations, workers)), workers))
+            if None in durations.values():
+                msg.append("Platforms without history are not counted.")
+            show_msg_block(msg, title="Build plan")
+
+    def _get_depends(self, projects):
+        return load_build_depends(projects)
+
+
+# Slots of worker hosts, a command on a host holds one of them. Created before each pool and
+# inherited by its processes, semaphores can not be pickled with the tasks. A terminated pool
+# may leave slots acquired, so they are never reused.
+HostSlots = dict()
+
+
+def reset_host_slots(hosts):
+    HostSlots.clear()
+    HostSlots.update((host, multiprocessing.BoundedSemaphore(slots)) for host, slots in hosts.items())
+
+
+# Platforms are spread over worker hosts by expected duration, longest first to the least loaded host.
+# The pool runs as many platforms as all hosts have slots, a platform waits for a slot of its host.
+class HostAssigner(Worker):
+    title = "Assign hosts"
+
+    def _run(self):
+        durations = self.env_config.platform_durations
+        known = [_ for _ in durations.values() if _ is not None]
+        default = sum(known) / len(known) if known else 1
+        hosts = self.env_config.hosts
+        loads = dict((host, 0) for host in hosts)
+
+        assignment = dict()
+        for platform in lpt_order(dict((_, durations.get(_)) for _ in self.env_config.target_platforms)):
+            duration = durations.get(platform) or default
+            host = min(sorted(hosts), key=lambda _: (loads[_] + duration) / float(hosts[_]))
+            assignment[platform] = host
+            loads[host] += duration
+
+        self.env_config.set_platform_hosts(assignment)
+        show_msg_block(["[%s] %s" % (host, " ".join(sorted(_ for _ in assignment if assignment[_] == host)))
+                        for host in sorted(hosts)], title="Host assignment")
+
+
+class PackageFanOut(Worker):
+    title = "Fan out package"
+
+    def run_platform(self, platform):
+        spks = self.package.spk_config.chroot_spks(self.env_config.get_chroot(platform))
+        for member in self.env_config.platform_members.get(platform, []):
+            dest_dir = self.package.spk_config.chroot_packages_dir(self.env_config.get_chroot(member))
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+
+            for spk in spks:
+                print("[%s] %s -> %s" % (platform, spk, dest_dir))
+                shutil.copy(spk, dest_dir)
+
+
 class CodeSignWorker(Worker):
     title = "Generate code sign"
 
     def _run(self):
         return doPlatformParallel(self._code_sign, self.env_config.platforms)
 
-    def check_gpg_key_exist(self):
+    def check_gpg_key_exist(self, platform):
         try:
-            gpg = check_output(['gpg', '--list-keys']).decode().strip()
+            gpg = self.env_config.get_executor(platform).check_output(
+                self.env_config.get_chroot(platform), 'gpg --list-keys').strip()
         except CalledProcessError:
             return False
 
         return gpg
 
+    def run_platform(self, platform):
+        return self._code_sign(platform)
+
     def _code_sign(self, platform):
         spks = self.package.spk_config.chroot_spks(self.env_config.get_chroot(platform))
         if not spks:
             raise SignPackageError('[%s] No spk found' % platform)
 
+        chroot = self.env_config.get_chroot(platform)
+        executor = self.env_config.get_executor(platform)
         for spk in spks:
             cmd = ' php ' + PkgScripts + '/CodeSign.php --sign=/image/packages/' + os.path.basename(spk)
-            with Chroot(self.env_config.get_chroot(platform)):
-                if not self.check_gpg_key_exist():
-                    raise SignPackageError("[%s] Gpg key not exist. You can add `-S' to skip package code sign or import gpg key first." % platform)
+            if not self.check_gpg_key_exist(platform):
+                raise SignPackageError("[%s] Gpg key not exist. You can add `-S' to skip package code sign or import gpg key first." % platform)
+
+            print("[%s] Sign package: " % platform + cmd)
+            log = os.path.join(chroot, 'logs.sign')
+            if executor.run(chroot, "set -o pipefail; %s 2>&1 | tee logs.sign" % cmd, log)[0] != 0:
+                raise SignPackageError('Failed to create signature: %s\nError log: %s' % (spk, log))
 
-                print("[%s] Sign package: " % platform + cmd)
-                try:
-                    check_call(cmd, shell=True, executable="/bin/bash")
-                except CalledProcessError:
-                    raise SignPackageError('Failed to create signature: ' + spk)
+        try:
+            executor.pull(chroot, ['image/packages'])
+        except ExecutorError as e:
+            raise SignPackageError("[%s] %s" % (platform, str(e)))
 
 
 class PackageCollecter(Worker):
     title = "Collect package"
 
+    @property
+    def result_dir(self):
+        return self.package.spk_config.spk_result_dir(self.env_config.suffix)
+
     def _run(self):
         spks = defaultdict(list)
 
-        dest_dir = self.package.spk_config.spk_result_dir(self.env_config.suffix)
+        dest_dir = self.result_dir
         if os.path.exists(dest_dir):
             old_dir = dest_dir + '.bad.' + strftime('%Y%m%d-%H%M', localtime())
             if os.path.isdir(old_dir):
@@ -295,7 +903,7 @@ class PackageCollecter(Worker):
             os.rename(dest_dir, old_dir)
         os.makedirs(dest_dir)
 
-        for platform in self.env_config.platforms:
+        for platform in self.env_config.build_platforms & self.package.platforms:
             for spk in self.package.spk_config.chroot_spks(self.env_config.get_chroot(platform)):
                 spks[os.path.basename(spk)].append(spk)
 
@@ -367,9 +975,19 @@ class CommandRunner(Worker):
 
 # Run SynoBuild/SynoInstall in chroot
 class ChrootRunner(CommandRunner):
-    def __init__(self, package, env_config, print_log=False):
+    # synced with worker hosts before and after the command, the remote source keeps the build output
+    # SynoInstall of a later stage needs, it only exists on the host
+    __push_paths__ = ['source', os.path.basename(ScriptDir)]
+    __push_keep_paths__ = ['source']
+    __pull_paths__ = ['logs', 'image/packages']
+
+    def __init__(self, package, env_config, print_log=False, sample_interval=0, timeout_policy=None,
+                 memory_high=None):
         CommandRunner.__init__(self, package, env_config)
         self.print_log = print_log
+        self.sample_interval = sample_interval
+        self.timeout_policy = timeout_policy
+        self.memory_high = memory_high
         self.__log__ = None
 
     def _process_output(self, output):
@@ -398,25 +1016,89 @@ class ChrootRunner(CommandRunner):
     def get_platform_log(self, platform):
         return os.path.join(self.env_config.get_chroot(platform), self.log)
 
+    def _get_env(self):
+        env = ['env', 'PackageName=' + shlex.quote(self.package.name)]
+        if self.env_config.source_date_epoch is not None:
+            # tar members given on command line keep the order of ls and globs
+            env += ['SOURCE_DATE_EPOCH=%d' % self.env_config.source_date_epoch, 'LC_COLLATE=C']
+
+        return env
+
+    # project and stage timeouts from durations of previous runs, projects are killed by the watchdog,
+    # the stage timeout follows the projects to run if their durations are known
+    def _get_timeouts(self, platform):
+        if not self.timeout_policy:
+            return None
+
+        with TimingDatabase(timing_db_file) as db:
+            return self.timeout_policy.get_timeouts(self.log.split('.')[-1],
+                                                    db.get_stage_time(self.package.name, platform, self.title),
+                                                    self._get_project_times(db, platform))
+
+    def _get_project_times(self, db, platform):
+        return dict()
+
+    def get_peak_rss(self, db, platform, default):
+        rss = db.get_peak_rss(platform, self.title)
+        return rss if rss is not None else default
+
     def run_command(self, platform, *argv):
         cmd = self._wrap_cmd(self._get_command(platform, *argv))
+        chroot = self.env_config.get_chroot(platform)
+        executor = self.env_config.get_executor(platform)
+        log = self.get_platform_log(platform)
+        timeouts = self._get_timeouts(platform)
+        cgroup = None
+        if self.memory_high and executor.host == LocalHost:
+            cgroup = self.memory_high.new_cgroup(platform, self.env_config.platform_memory.get(platform))
+
+        if os.path.isfile(log):
+            os.rename(log, log + '.old')
+
+        print("[%s] " % platform + " ".join(cmd))
+        slot = HostSlots.get(executor.host)
+        if slot:
+            slot.acquire()
+        init_time = time()
+        try:
+            if executor.host != LocalHost:
+                print("[%s] Run on %s" % (platform, executor.host))
+            executor.push(chroot, self.__push_paths__, self.__push_keep_paths__)
+            returncode, self.resource_usage = executor.run(chroot, " ".join(cmd), log, self.sample_interval,
+                                                           timeouts, cgroup)
+            executor.pull(chroot, self.__pull_paths__)
+        except ExecutorError as e:
+            raise self.__failed_exception__("[%s] %s" % (platform, str(e)))
+        finally:
+            if slot:
+                slot.release()
+        self.counters = self._get_counters(platform, init_time)
+
+        if returncode != 0:
+            failed_projs = self.__get_failed_projects(log)
+            if not failed_projs:
+                raise self.__failed_exception__("%s failed. \n Error log: %s" % (" ".join(cmd), log))
+            return failed_projs
 
-        with Chroot(self.env_config.get_chroot(platform)):
-            self._rename_log()
-            try:
-                print("[%s] " % platform + " ".join(cmd))
-                with open(os.devnull, 'wb') as null:
-                    check_call(" ".join(cmd), stdout=null, shell=True, executable='/bin/bash')
-            except CalledProcessError:
-                failed_projs = self.__get_failed_projects()
-                if not failed_projs:
-                    raise self.__failed_exception__("%s failed. \n Error log: %s"
-                                                    % (" ".join(cmd), self.get_platform_log(platform)))
-                return failed_projs
-
-    def __get_failed_projects(self):
+    # counters of the command on the platform, passed back from the pool with the results
+    def _get_counters(self, platform, init_time):
+        log_type = self.log.split('.')[-1]
+        project_logs = glob.glob(os.path.join(self.env_config.get_chroot(platform), 'logs', '*.' + log_type))
+        log = self.get_platform_log(platform)
+        return {
+            'log_bytes': os.path.getsize(log) if os.path.isfile(log) else 0,
+            'project_log_bytes': sum(os.path.getsize(_) for _ in project_logs if os.path.getmtime(_) >= init_time),
+        }
+
+    def add_platform_metrics(self, metrics, platform, failed_projs, counters):
+        if counters:
+            metrics.add('stage_log_bytes', counters['log_bytes'], platform=platform, stage=self.title, log=self.log)
+            metrics.add('stage_log_bytes', counters['project_log_bytes'], platform=platform, stage=self.title,
+                        log='projects')
+
+    def __get_failed_projects(self, log):
         projects = []
-        with open(self.log, 'r') as fd:
+        with open(log, 'r') as fd:
             for line in fd:
                 if 'Error(s) occurred on project' not in line:
                     continue
@@ -425,8 +1107,12 @@ class ChrootRunner(CommandRunner):
         return projects
 
     def _run(self):
+        reset_host_slots(self.env_config.hosts)
         return doPlatformParallel(self.run_command, self.env_config.platforms)
 
+    def run_platform(self, platform):
+        return self.run_command(platform)
+
     @property
     def log(self):
         raise PkgCreateError("Not implemented")
@@ -435,24 +1121,135 @@ class ChrootRunner(CommandRunner):
 class PackageBuilder(ChrootRunner):
     title = "Build Package"
     log = "logs.build"
+    __push_paths__ = ChrootRunner.__push_paths__ + [PrebuiltDir]
+    __pull_paths__ = ChrootRunner.__pull_paths__ + ['env32.mak', 'env64.mak', PrebuiltDir]
     __error_msg__ = "Failed to build package."
     __failed_exception__ = BuildPackageError
 
     def __init__(self, package, env_config, sdk_ver, build_opt, *argv, **kwargs):
+        self.prebuilt_cache = kwargs.pop('prebuilt_cache', None)
         ChrootRunner.__init__(self, package, env_config, *argv, **kwargs)
         self.build_opt = build_opt
         self.sdk_ver = sdk_ver
+        self.clean = True
 
     def _get_command(self, platform):
         build_script = os.path.join(PkgScripts, 'SynoBuild')
-        projects = self.package.get_build_projects(platform)
 
-        build_cmd = ['env', 'PackageName=' + self.package.name, build_script, '--' + platform,
-                     '-c', '--min-sdk', self.sdk_ver]
+        # SynoBuild sorts projects by name unless --keep-order, which keeps the critical path order
+        build_cmd = self._get_env() + [build_script, '--' + platform, '-c' if self.clean else '-N',
+                                       '--min-sdk', self.sdk_ver, '--keep-order']
+        if self.prebuilt_cache:
+            build_cmd += ['--prebuilt-dir', '/' + PrebuiltDir]
         if self.build_opt:
             build_cmd.append(self.build_opt)
 
-        return build_cmd + list(projects)
+        return build_cmd + self.package.get_build_order(platform)
+
+    def run_command(self, platform, *argv):
+        if not self.prebuilt_cache:
+            return ChrootRunner.run_command(self, platform, *argv)
+
+        names, hits = self.__restore_prebuilt(platform)
+        failed_projs = ChrootRunner.run_command(self, platform, *argv)
+        self.__store_prebuilt(platform, names, set(hits) | set(failed_projs or []))
+        self.counters['prebuilt_projects'] = len(hits)
+        return failed_projs
+
+    # SynoBuild stages <proj>.txz found in the dir and exports the other listed projects after building them
+    def __restore_prebuilt(self, platform):
+        prebuilt_dir = os.path.join(self.env_config.get_chroot(platform), PrebuiltDir)
+        if os.path.isdir(prebuilt_dir):
+            shutil.rmtree(prebuilt_dir)
+        os.makedirs(prebuilt_dir)
+
+        projects = self.package.get_build_projects(platform) - set(self.package.get_roots(platform))
+        names = self.prebuilt_cache.get_names(projects, load_build_depends(projects), platform,
+                                              self.env_config.get_toolkit_version(platform),
+                                              self.__get_prebuilt_options())
+        hits = []
+        for proj, name in sorted(names.items()):
+            blob = self.prebuilt_cache.lookup(name)
+            if blob:
+                shutil.copy(blob, os.path.join(prebuilt_dir, proj + '.txz'))
+                hits.append(proj)
+
+        with open(os.path.join(prebuilt_dir, 'projects'), 'w') as fd:
+            fd.write("\n".join(sorted(names)) + "\n")
+
+        print("[%s] Prebuilt %d of %d pinned projects: %s" % (platform, len(hits), len(names), " ".join(hits)))
+        return names, hits
+
+    # SynoBuild options and environment which change the output of a project
+    def __get_prebuilt_options(self):
+        options = ['--min-sdk', self.sdk_ver]
+        if self.build_opt:
+            options.append(self.build_opt)
+        if self.env_config.source_date_epoch is not None:
+            options.append('SOURCE_DATE_EPOCH=%d' % self.env_config.source_date_epoch)
+
+        return options
+
+    def __store_prebuilt(self, platform, names, skipped):
+        prebuilt_dir = os.path.join(self.env_config.get_chroot(platform), PrebuiltDir)
+        for proj, name in sorted(names.items()):
+            output = os.path.join(prebuilt_dir, proj + '.txz')
+            if proj in skipped or not os.path.isfile(output):
+                continue
+            try:
+                self.prebuilt_cache.insert(name, output)
+            except TarballStoreError as e:
+                print("[%s] [WARNING] %s" % (platform, str(e)))
+
+    def _get_project_times(self, db, platform):
+        return dict((_, db.get_project_time(platform, _)) for _ in self.package.get_build_projects(platform))
+
+    # SynoBuild builds one project after another, projects too short to be sampled are bound by the stage
+    def get_peak_rss(self, db, platform, default):
+        stage_rss = ChrootRunner.get_peak_rss(self, db, platform, default)
+        peaks = [db.get_peak_rss(platform, self.title, _) for _ in self.package.get_build_projects(platform)]
+        if not peaks:
+            return stage_rss
+
+        return max(_ if _ is not None else stage_rss for _ in peaks)
+
+    # SynoBuild zeroes ccache stats before building, stats of builds without ccache are older
+    def _get_counters(self, platform, init_time):
+        counters = ChrootRunner._get_counters(self, platform, init_time)
+        counters['ccache'] = read_ccache_stats(os.path.join(self.env_config.get_chroot(platform), 'ccaches'),
+                                               init_time)
+        return counters
+
+    def add_platform_metrics(self, metrics, platform, failed_projs, counters):
+        ChrootRunner.add_platform_metrics(self, metrics, platform, failed_projs, counters)
+        projects = self.package.get_build_projects(platform)
+        states = {'skipped': len(self.package.get_unaffected_projects(platform))}
+        if counters is None:
+            states['skipped'] += len(projects)
+        else:
+            states['failed'] = len(failed_projs or [])
+            states['prebuilt'] = counters.get('prebuilt_projects', 0)
+            states['built'] = len(projects) - states['failed'] - states['prebuilt']
+        for state, count in states.items():
+            metrics.add('projects', count, platform=platform, state=state)
+
+        stats = counters and counters['ccache']
+        if not stats:
+            return
+
+        hits = stats['direct_hits'] + stats['preprocessed_hits']
+        metrics.add('ccache_hits', stats['direct_hits'], platform=platform, kind='direct')
+        metrics.add('ccache_hits', stats['preprocessed_hits'], platform=platform, kind='preprocessed')
+        metrics.add('ccache_misses', stats['misses'], platform=platform)
+        if hits + stats['misses']:
+            metrics.add('ccache_hit_ratio', hits / float(hits + stats['misses']), platform=platform)
+
+    def record_timing(self, db, platform):
+        log_dir = os.path.join(self.env_config.get_chroot(platform), 'logs')
+        for proj in self.package.get_build_projects(platform):
+            elapsed = parse_time_cost(os.path.join(log_dir, proj + '.build'))
+            if elapsed is not None:
+                db.add_project_time(platform, proj, 'build', elapsed)
 
 
 class PackageInstaller(ChrootRunner):
@@ -461,26 +1258,200 @@ class PackageInstaller(ChrootRunner):
     __error_msg__ = "Failed to install package."
     __failed_exception__ = InstallPacageError
 
-    def __init__(self, package, env_config, install_opt, print_log):
-        ChrootRunner.__init__(self, package, env_config, print_log)
+    def __init__(self, package, env_config, install_opt, print_log, sample_interval=0, timeout_policy=None,
+                 memory_high=None):
+        ChrootRunner.__init__(self, package, env_config, print_log, sample_interval, timeout_policy, memory_high)
         self.install_opt = list(install_opt)
+        if '--with-debug' in self.install_opt:
+            self.title = "Install Debug Package"
 
     def _get_command(self, platform):
-        cmd = ['env', 'PackageName=' + self.package.name, os.path.join(PkgScripts, 'SynoInstall')]
+        cmd = self._get_env() + [os.path.join(PkgScripts, 'SynoInstall')]
         if self.install_opt:
             cmd += self.install_opt
 
         return cmd + [self.package.name]
 
 
+# Each platform goes through build, install and sign as soon as its own previous stage is done,
+# instead of waiting for the slowest platform between stages.
+class PlatformPipeline(Worker):
+    title = "Platform pipeline"
+
+    def __init__(self, package, env_config, fail_fast=False, memory_admission=None):
+        Worker.__init__(self, package, env_config)
+        self.memory_admission = memory_admission
+        self.stages = []
+        self.platform_records = dict()
+        self.platform_usage = dict()
+        self.platform_failures = dict()
+        self.platform_counters = dict()
+        self.fail_fast = fail_fast
+        self.record = True
+
+    def add_stage(self, worker):
+        self.stages.append(worker)
+
+    def _check_executable(self):
+        return len(self.stages) > 0
+
+    def _run(self):
+        durations = self.env_config.platform_durations
+        platforms = lpt_order(dict((_, durations.get(_)) for _ in self.env_config.target_platforms))
+        reset_host_slots(self.env_config.hosts)
+        if not self.memory_admission:
+            return doPlatformParallel(self._run_platform, platforms)
+
+        self.memory_admission.start(self.env_config.platform_memory)
+        return doAdmittedPlatformParallel(self._run_platform, platforms, self.memory_admission)
+
+    def _run_platform(self, platform):
+        results = []
+        done = self.env_config.done_stages.get(platform, set())
+        resumable = True
+        for stage in self.stages:
+            # package of a batch not available on the platform
+            if platform not in stage.package.platforms:
+                continue
+
+            # once a stage runs again, its results invalidate the later stages
+            if resumable and stage.title in done:
+                print("[%s] Skip %s, done by previous run." % (platform, stage.title))
+                continue
+            resumable = False
+
+            init_time = time()
+            try:
+                output = stage.run_platform(platform)
+            except Exception:
+                self._add_journal(platform, stage, 'failed')
+                raise
+            self._add_journal(platform, stage, 'failed' if output else 'done')
+            results.append((stage.title, output, time() - init_time, stage.resource_usage, stage.counters))
+
+            # failed projects are returned, later stages are meaningless
+            if output:
+                if self.fail_fast:
+                    raise stage.__failed_exception__("%s [%s] : %s" % (stage.__error_msg__, platform, " ".join(output)))
+                break
+
+        return results
+
+    def _add_journal(self, platform, stage, status):
+        fingerprint = self.env_config.platform_fingerprints.get(platform)
+        if fingerprint and self.record:
+            self.env_config.journal.add(platform, stage.title, fingerprint, status)
+
+    def _process_output(self, output):
+        errors = []
+
+        for platform, results in output.items():
+            self.platform_records[platform] = [(title, elapsed) for title, _, elapsed, _, _ in results]
+            self.platform_usage[platform] = dict((title, usage) for title, _, _, usage, _ in results if usage)
+            self.platform_failures[platform] = dict((title, failed_projs) for title, failed_projs, _, _, _ in results)
+            self.platform_counters[platform] = dict((title, counters) for title, _, _, _, counters in results)
+        if self.record:
+            self._record_timing(output)
+
+        for stage in self.stages:
+            stage_output = dict()
+            for platform, results in output.items():
+                for title, failed_projs, _, _, _ in results:
+                    if title == stage.title:
+                        stage_output[platform] = failed_projs
+
+            try:
+                stage._process_output(stage_output)
+            except PkgCreateError as e:
+                errors.append(e)
+
+        if errors:
+            raise errors[0]
+
+    def _record_timing(self, output):
+        stages = dict((stage.title, stage) for stage in self.stages)
+        with TimingDatabase(timing_db_file) as db:
+            for platform, results in output.items():
+                for title, failed_projs, elapsed, usage, _ in results:
+                    # peaks of failed stages count, the failure may be out of memory
+                    if usage:
+                        self._record_peak_rss(db, platform, title, usage)
+                    if failed_projs:
+                        break
+                    db.add_stage_time(self.package.name, platform, title, elapsed)
+                    stages[title].record_timing(db, platform)
+
+    def _record_peak_rss(self, db, platform, title, usage):
+        db.add_peak_rss(platform, title, '', usage['rss_peak'])
+        for proj, rss in usage['project_rss_peak'].items():
+            db.add_peak_rss(platform, title, proj, rss)
+
+    def get_time_cost(self):
+        time_cost = Worker.get_time_cost(self)
+        for platform in sorted(self.platform_records):
+            for title, elapsed in self.platform_records[platform]:
+                time_cost.append("%s: [%s] %s" % (strftime('%H:%M:%S', gmtime(elapsed)), platform, title))
+                usage = self.platform_usage[platform].get(title)
+                if usage:
+                    time_cost.append("          " + format_usage(usage))
+
+        return time_cost
+
+    def get_time_records(self):
+        records = Worker.get_time_records(self)
+        for stage in self.stages:
+            elapsed = [dict(_).get(stage.title) for _ in self.platform_records.values()]
+            elapsed = [_ for _ in elapsed if _ is not None]
+            if elapsed:
+                records.append((stage.title, max(elapsed)))
+
+        return records
+
+    # stages skipped by _run_platform, done by previous run before the first stage run again
+    def _get_resumed_stages(self, platform):
+        titles = [title for title, _ in self.platform_records.get(platform, [])]
+        resumed = []
+        for stage in self.stages:
+            if platform not in stage.package.platforms:
+                continue
+            if stage.title in titles or stage.title not in self.env_config.done_stages.get(platform, set()):
+                break
+            resumed.append(stage)
+
+        return resumed
+
+    def add_metrics(self, metrics):
+        Worker.add_metrics(self, metrics)
+        stages = dict((stage.title, stage) for stage in self.stages)
+        for platform in sorted(self.platform_records):
+            for stage in self._get_resumed_stages(platform):
+                metrics.add('stage_resumed', 1, platform=platform, stage=stage.title)
+                stage.add_platform_metrics(metrics, platform, None, None)
+
+            for title, elapsed in self.platform_records[platform]:
+                failed_projs = self.platform_failures[platform][title]
+                metrics.add('stage_duration_seconds', elapsed, platform=platform, stage=title)
+                metrics.add('stage_failed_projects', len(failed_projs or []), platform=platform, stage=title)
+                metrics.add_usage('stage', self.platform_usage[platform].get(title), platform=platform, stage=title)
+                stages[title].add_platform_metrics(metrics, platform, failed_projs,
+                                                   self.platform_counters[platform][title])
+
+
 class Package():
     def __init__(self, package):
         self.name = package
         self.package_proj = BuildEnv.Project(self.name)
-        self.dict_projects = dict()
+        self.__projects = dict()
+        self.__build_order = dict()
+        self.__affected = None
         self.__additional_build = defaultdict(list)
         self.__spk_config = None
         self.__chroot = None
+        self.platforms = set()
+
+    # projects the traversal starts from
+    def get_roots(self, platform):
+        return [self.name]
 
     def get_additional_build_projs(self, platform):
         if platform in self.__additional_build:
@@ -490,12 +1461,36 @@ class Package():
     def add_additional_build_projs(self, platform, projs):
         self.__additional_build[platform] += projs
 
-    @property
-    def ref_projs(self):
-        return self.dict_projects['refs'] | self.dict_projects['refTags']
+    def set_projects(self, platforms, dict_projects):
+        for platform in platforms:
+            self.__projects[platform] = dict_projects
+
+    def get_ref_projects(self, platform):
+        dict_projects = self.__projects[platform]
+        return dict_projects['refs'] | dict_projects['refTags']
 
     def get_build_projects(self, platform):
-        return self.dict_projects['branches'] | self.get_additional_build_projs(platform)
+        projects = self.__projects[platform]['branches'] | self.get_additional_build_projs(platform)
+        if self.__affected is not None:
+            projects &= self.__affected
+
+        return projects
+
+    # build projects left out by --changed or --watch
+    def get_unaffected_projects(self, platform):
+        projects = self.__projects[platform]['branches'] | self.get_additional_build_projs(platform)
+        return projects - self.get_build_projects(platform)
+
+    def set_affected_projects(self, projects):
+        self.__affected = set(projects) if projects is not None else None
+
+    def set_build_order(self, platform, order):
+        self.__build_order[platform] = order
+
+    def get_build_order(self, platform):
+        projects = self.get_build_projects(platform)
+        order = [_ for _ in self.__build_order.get(platform, []) if _ in projects]
+        return order + sorted(projects - set(order))
 
     @property
     def spk_config(self):
@@ -516,6 +1511,20 @@ class Package():
     def collect(self):
         return self.package_proj.collect(self.chroot)
 
+    @property
+    def is_noarch(self):
+        info = self.package_proj.info()
+        if os.path.isfile(info):
+            info = config_parser.KeyValueParser(info)
+            return 'arch' in info.keys() and info['arch'] == 'noarch'
+
+        info_sh = info + '.sh'
+        if os.path.isfile(info_sh):
+            with open(info_sh, 'r') as fd:
+                return re.search(r'^\s*arch=["\']?noarch\b', fd.read(), re.M) is not None
+
+        return False
+
     @property
     def chroot(self):
         return self.__chroot
@@ -525,6 +1534,22 @@ class Package():
         self.__chroot = chroot
 
 
+# Packages built in one run: projects of all packages are traversed, linked and built together,
+# install, sign and collect are done by each package on its own platforms.
+class PackageBatch(Package):
+    def __init__(self, packages):
+        Package.__init__(self, "+".join(_.name for _ in packages))
+        self.packages = packages
+        self.platforms = set().union(*[_.platforms for _ in packages])
+
+    def get_roots(self, platform):
+        return [_.name for _ in self.packages if platform in _.platforms]
+
+    @property
+    def is_noarch(self):
+        return all(_.is_noarch for _ in self.packages)
+
+
 class SpkConfig:
     def __init__(self, name, info, settings):
         self.info = config_parser.KeyValueParser(info)
@@ -553,7 +1578,8 @@ class SpkConfig:
 
     @property
     def spk_pattern(self):
-        return self.name + '*' + self.version + '*spk'
+        # the dash keeps spks of a package named with the same prefix apart, e.g. Foo and Foo2
+        return self.name + '-*' + self.version + '*spk'
 
     def chroot_packages_dir(self, chroot):
         return os.path.join(chroot, 'image', 'packages')
@@ -569,20 +1595,95 @@ class SpkConfig:
 
 
 class EnvConfig():
-    def __init__(self, package, env_section, version, platforms, dep_level, branch, suffix):
-        self.dict_env = getBaseEnvironment(package, env_section, version)
+    def __init__(self, packages, env_section, version, platforms, dep_level, branch, suffix):
+        self.dict_envs = dict((_, getBaseEnvironment(_, env_section, version)) for _ in packages)
         self.suffix = suffix
         self.env_section = env_section
         self.env_version = version
         self.dep_level = dep_level
         self.branch = branch
-        self.platforms = set(self.__get_package_platforms(platforms))
+        self.package_platforms = dict()
+        self.platform_versions = self.__resolve_platform_versions(packages, platforms)
+        self.platforms = set(self.platform_versions)
         self.toolkit_versions = self.__resolve_toolkit_versions()
+        self.platform_members = dict()
+        self.platform_durations = dict()
+        self.platform_memory = dict()
+        self.affected_platforms = None
+        self.hosts = dict()
+        self.remote_base = None
+        self.platform_hosts = dict()
+        self.journal = RunJournal(journal_file)
+        self.platform_fingerprints = dict()
+        self.done_stages = dict()
+        self.source_date_epoch = None
 
         if not self.platforms:
             raise PkgCreateError("No platform found!")
 
-    def __get_package_platforms(self, platforms):
+    # platforms actually built, the others get the result of their representative
+    @property
+    def build_platforms(self):
+        if not self.platform_members:
+            return self.platforms
+
+        return set(self.platform_members)
+
+    # platforms going through the pipeline, a representative is built if any of its members is affected
+    @property
+    def target_platforms(self):
+        if self.affected_platforms is None:
+            return self.build_platforms
+
+        return set(_ for _ in self.build_platforms
+                   if self.affected_platforms & set([_] + self.platform_members.get(_, [])))
+
+    def set_hosts(self, hosts, remote_base=None):
+        self.hosts = hosts
+        self.remote_base = remote_base
+
+    def set_platform_hosts(self, platform_hosts):
+        self.platform_hosts = platform_hosts
+
+    def get_executor(self, platform):
+        return new_executor(self.platform_hosts.get(platform), BaseDir, self.remote_base, Chroot)
+
+    def set_affected_platforms(self, platforms):
+        self.affected_platforms = set(platforms) if platforms is not None else None
+
+    def set_platform_members(self, members):
+        self.platform_members = members
+
+    def set_platform_durations(self, durations):
+        self.platform_durations = durations
+
+    def set_platform_memory(self, memory):
+        self.platform_memory = memory
+
+    def set_platform_fingerprints(self, fingerprints):
+        self.platform_fingerprints.update(fingerprints)
+
+    def set_done_stages(self, done_stages):
+        self.done_stages.update(done_stages)
+
+    def set_source_date_epoch(self, epoch):
+        self.source_date_epoch = epoch
+
+    # packages of a batch must use the same toolkit version on a platform, they share its chroot
+    def __resolve_platform_versions(self, packages, platforms):
+        versions = dict()
+        for package in packages:
+            dict_env = self.dict_envs[package]
+            self.package_platforms[package] = set(self.__get_package_platforms(dict_env, platforms))
+            for platform in self.package_platforms[package]:
+                version = get_env_version(dict_env, platform)
+                if versions.setdefault(platform, version) != version:
+                    raise PkgCreateError("[%s] %s requires version %s, but other packages require %s" % (
+                        platform, package, version, versions[platform]))
+
+        return versions
+
+    def __get_package_platforms(self, dict_env, platforms):
         def __get_toolkit_available_platforms(version):
             toolkit_config = os.path.join(ScriptDir, 'include', 'toolkit.config')
             major, minor = version.split('.')
@@ -591,9 +1692,9 @@ class EnvConfig():
                                 shell=True, executable='/bin/bash').decode().split()
 
         package_platforms = set()
-        for platform in self.dict_env:
+        for platform in dict_env:
             if platform == 'all':
-                package_platforms |= set(__get_toolkit_available_platforms(self.dict_env['all']))
+                package_platforms |= set(__get_toolkit_available_platforms(dict_env['all']))
             else:
                 package_platforms.add(platform)
 
@@ -601,17 +1702,19 @@ class EnvConfig():
             package_platforms = set(package_platforms) & set(platforms)
 
         # remove platform if dir not exist
-        return [platform for platform in package_platforms if os.path.isdir(self.get_chroot(platform))]
+        return [platform for platform in package_platforms
+                if os.path.isdir(BuildEnv.getChrootSynoBase(platform, get_env_version(dict_env, platform), self.suffix))]
 
     def __get_version(self, platform):
-        if platform in self.dict_env:
-            version = self.dict_env[platform]
-        elif 'all' in self.dict_env:
-            version = self.dict_env['all']
-        else:
+        if platform not in self.platform_versions:
             raise PkgCreateError("Package version not found")
 
-        return version
+        return self.platform_versions[platform]
+
+    def get_toolkit_version(self, platform):
+        for version, platforms in self.toolkit_versions.items():
+            if platform in platforms:
+                return version
 
     def get_version_map_file(self, platform):
         return os.path.join(self.get_chroot(platform), 'version_map')
@@ -654,6 +1757,7 @@ class EnvConfig():
 class PackagePacker:
     def __init__(self):
         self.__workers = []
+        self.collecters = []
 
     def add_worker(self, worker):
         self.__workers.append(worker)
@@ -669,6 +1773,34 @@ class PackagePacker:
 
         show_msg_block(time_cost, title="Time Cost Statistic")
 
+    def get_time_records(self):
+        records = []
+        for worker in self.__workers:
+            records += worker.get_time_records()
+
+        return records
+
+    def write_metrics(self, path, elapsed, succeeded, package):
+        metrics = Metrics('pkgcreate', MetricFamilies)
+        for worker in self.__workers:
+            worker.add_metrics(metrics)
+        metrics.add_run(elapsed, succeeded, package=package)
+        metrics.write(path)
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+
+    return strftime('%H:%M:%S', gmtime(seconds))
+
+
+def get_env_version(dict_env, platform):
+    if platform in dict_env:
+        return dict_env[platform]
+
+    return dict_env.get('all')
+
 
 def getBaseEnvironment(proj, env, ver=None):
     dict_env = {}
@@ -684,38 +1816,178 @@ def getBaseEnvironment(proj, env, ver=None):
     return dict_env
 
 
-def main(argv):
-    args = args_parser(argv)
+# processes of a platform on a worker host are not children of the terminated pool
+def cancel_platforms(env_config, platforms):
+    for platform in platforms:
+        executor = env_config.get_executor(platform)
+        print("[%s] Cancelled, kill processes in chroot%s." % (
+            platform, " on " + executor.host if executor.host != LocalHost else ""))
+        executor.cancel(env_config.get_chroot(platform))
+
+
+def create_packer(args):
     packer = PackagePacker()
     worker_factory = WorkerFactory(args)
     new_worker = worker_factory.new
 
-    prepare_worker = new_worker(EnvPrepareWorker, args.update)
+    if args.fail_fast:
+        setFailFast(True, cleanup=lambda platforms: cancel_platforms(worker_factory.env_config, platforms))
+
+    if args.reproducible:
+        epoch = get_source_date_epoch([os.path.join(BuildEnv.SourceDir, BuildEnv.deVirtual(_.name))
+                                       for _ in worker_factory.packages])
+        if epoch is None:
+            raise PkgCreateError("Can not get commit time of packages, set SOURCE_DATE_EPOCH.")
+        print("SOURCE_DATE_EPOCH=%d" % epoch)
+        worker_factory.env_config.set_source_date_epoch(epoch)
+
+    prepare_worker = new_worker(EnvPrepareWorker, args.update, args.git_remote, args.git_mirror, args.git_tag)
     prepare_worker.add_subworker(new_worker(ProjectTraverser))
+    if args.resume:
+        prepare_worker.add_subworker(new_worker(JournalChecker, args))
     if args.link:
         prepare_worker.add_subworker(new_worker(ProjectLinker))
     packer.add_worker(prepare_worker)
 
-    if args.build:
-        packer.add_worker(new_worker(PackageBuilder, args.sdk_ver, args.build_opt, args.print_log))
+    if args.changed:
+        packer.add_worker(new_worker(AffectedProjectSelector, args.changed))
+
+    if args.dedup:
+        packer.add_worker(new_worker(PlatformDeduplicator))
 
-    if args.install:
-        packer.add_worker(new_worker(PackageInstaller,
-                                     install_opt=[args.install_opt, '--with-debug'],
-                                     print_log=args.print_log))
-        packer.add_worker(new_worker(PackageInstaller,
-                                     install_opt=[args.install_opt],
-                                     print_log=args.print_log))
+    # platforms on worker hosts do not take memory of this host
+    memory_admission = None
+    if args.memory_limit is not None and not args.hosts:
+        memory_admission = MemoryAdmission(int(args.memory_limit * 1024 ** 3))
 
+    memory_high = None
+    if args.memory_high:
+        try:
+            memory_high = MemoryHighPolicy(setup_memory_cgroup(), args.memory_high)
+        except MemoryCgroupError as e:
+            raise PkgCreateError(str(e))
+
+    pipeline = new_worker(PlatformPipeline, args.fail_fast, memory_admission)
+    timeout_policy = TimeoutPolicy(args.timeout_factor, args.min_timeout, args.stage_timeout, args.project_timeout)
+    if args.build:
+        prebuilt_cache = None
+        if args.prebuilt_cache:
+            prebuilt_cache = PrebuiltCache(args.prebuilt_cache, int(args.prebuilt_cache_size * 1024 ** 3))
+        pipeline.add_stage(new_worker(PackageBuilder, args.sdk_ver, args.build_opt, args.print_log,
+                                      args.sample_interval, timeout_policy, memory_high,
+                                      prebuilt_cache=prebuilt_cache))
+
+    for package in worker_factory.packages:
+        new_package_worker = partial(worker_factory.new_package, package)
+        if args.install:
+            pipeline.add_stage(new_package_worker(PackageInstaller,
+                                                  install_opt=[args.install_opt, '--with-debug'],
+                                                  print_log=args.print_log,
+                                                  sample_interval=args.sample_interval,
+                                                  timeout_policy=timeout_policy,
+                                                  memory_high=memory_high))
+            pipeline.add_stage(new_package_worker(PackageInstaller,
+                                                  install_opt=[args.install_opt],
+                                                  print_log=args.print_log,
+                                                  sample_interval=args.sample_interval,
+                                                  timeout_policy=timeout_policy,
+                                                  memory_high=memory_high))
+
+        if args.collect and args.sign:
+            pipeline.add_stage(new_package_worker(CodeSignWorker))
+
+        if args.dedup and args.install:
+            pipeline.add_stage(new_package_worker(PackageFanOut))
+
+    packer.add_worker(new_worker(BuildScheduler, pipeline, args.plan, int(args.default_memory * 1024 ** 3)))
+    if args.plan:
+        return packer
+
+    if args.hosts:
+        hosts = parse_hosts(args.hosts)
+        worker_factory.env_config.set_hosts(hosts, args.remote_base)
+        setPoolSize(sum(hosts.values()))
+        packer.add_worker(new_worker(HostAssigner))
+    packer.add_worker(pipeline)
+
+    # collecting checks duplicated spks over all platforms, it is the only global join
+    collecters = []
     if args.collect:
-        if args.sign:
-            packer.add_worker(new_worker(CodeSignWorker))
+        collecters = [worker_factory.new_package(package, PackageCollecter) for package in worker_factory.packages]
+        packer.collecters = collecters
+    for collecter in collecters:
+        packer.add_worker(collecter)
+
+    if args.watch:
+        packer.add_worker(new_worker(ProjectWatcher, pipeline, [pipeline] + collecters, args.link))
+
+    return packer
+
+
+def get_result_digests(result_dirs):
+    digests = dict()
+    for result_dir in result_dirs:
+        for spk in sorted(glob.glob(os.path.join(result_dir, '*.spk'))):
+            digests[os.path.basename(spk)] = digest_archive(spk)
+
+    return digests
 
-        packer.add_worker(new_worker(PackageCollecter))
 
-    packer.pack_package()
+# Pack twice from scratch and compare collected spks member by member
+def verify_reproducible(args):
+    runs = []
+    for run in range(2):
+        show_msg_block(["Run %d of 2" % (run + 1)], title="Verify reproducible")
+        packer = run_packer(args)
+        runs.append(get_result_digests([_.result_dir for _ in packer.collecters]))
+
+    if not runs[0]:
+        raise PkgCreateError("No spk collected to verify.")
+
+    msg = []
+    for spk in sorted(set(runs[0]) | set(runs[1])):
+        if spk not in runs[0] or spk not in runs[1]:
+            msg.append("%s: only in run %d" % (spk, 1 if spk in runs[0] else 2))
+            continue
+
+        members = diff_digests(runs[0][spk], runs[1][spk])
+        if members:
+            msg.append("%s differs:" % spk)
+            msg += ["    " + (_ or "(archive)") for _ in members]
+        else:
+            print("%s: identical (%s)" % (spk, runs[0][spk]['']))
+
+    if msg:
+        show_msg_block(msg, title="Not reproducible", error=True)
+        raise PkgCreateError("Packages of two runs differ.")
+
+
+def run_packer(args):
+    init_time = time()
+    packer = create_packer(args)
+    succeeded = False
+    try:
+        packer.pack_package()
+        succeeded = True
+    finally:
+        if args.metrics_file:
+            packer.write_metrics(args.metrics_file, time() - init_time, succeeded, "+".join(args.package))
     packer.show_time_cost()
 
+    return packer
+
+
+def main(argv):
+    args = args_parser(argv)
+    if args.profile:
+        profiler.enable(os.path.join(BaseDir, 'pkgcreate.profile'))
+    if args.verify:
+        verify_reproducible(args)
+        return
+
+    run_packer(args)
+
+
 if __name__ == '__main__':
     ret = 0
     try:
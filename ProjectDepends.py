@@ -7,11 +7,12 @@ import glob
 import argparse
 import re
 
-ScriptDir = os.path.dirname(os.path.abspath(sys.argv[0]))
+ScriptDir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(ScriptDir + '/include')
 sys.path.append(ScriptDir + '/include/python')
 import BuildEnv
 from config_parser import DependsParser, ProjectDependsParser
+import profiler
 
 # config file, to get basic project parameters
 section_depends = "project dependency"
@@ -28,17 +29,17 @@ dynamic_variable = "dynamic variable list"
 
 class DependencyError(Exception):
     def __init__(self, stack, proj):
-        self.stack = stack
+        self.stack = list(stack)
         self.project = proj
-        print("Error! Circluar dependency found!!")
+        Exception.__init__(self, "Circular dependency found: " + " -> ".join(self.getCircularDepList()))
+
+    def getCircularDepList(self):
+        return self.stack[self.stack.index(self.project):] + [self.project]
 
     def dumpCircluarDepList(self):
-        blFound = False
-        for proj in self.stack:
-            if proj == self.project:
-                blFound = True
-            if blFound:
-                print(proj + " -> ")
+        print("Error! Circluar dependency found!!")
+        for proj in self.getCircularDepList()[:-1]:
+            print(proj + " -> ")
         print(self.project)
 
 
@@ -75,12 +76,9 @@ class DepGraph:
 
             self.stack.pop()
 
+    # raises DependencyError on a circular dependency
     def traverseDepends(self, listProjs):
-        try:
-            self.traveseList(listProjs, 0)
-        except DependencyError as e:
-            e.dumpCircluarDepList()
-            sys.exit(1)
+        self.traveseList(listProjs, 0)
         return self.listOut
 
     def getReverseList(self, proj, traveseDict):
@@ -150,7 +148,7 @@ def isKernelHeaderProj(newProj):
 
 
 def normalizeProjects(projects, config, kernels):
-    out_projects = set()
+    out_projects = []
     blAddKernelHeader = None
     allKernels = config.all_kernels
 
@@ -161,14 +159,14 @@ def normalizeProjects(projects, config, kernels):
             newProj = ""
             blAddKernelHeader = True
         if newProj in allKernels:
-            out_projects.update(kernels)
+            out_projects.extend(kernels)
             continue
         elif newProj == libc_project:    # always skip libc
             newProj = ""
 
-        out_projects.add(newProj)
+        out_projects.append(newProj)
 
-    return blAddKernelHeader, list(out_projects)
+    return blAddKernelHeader, list(dict.fromkeys(out_projects))
 
 
 def findPlatformDependsProj(platformDependsSection, platforms):
@@ -221,6 +219,8 @@ def ParseArgs():
     parser.add_argument('-r', dest='r_level',  type=int, default=-1, help='Reverse depenedency traverse level')
     parser.add_argument('-x', dest='level',    type=int, default=-1, help="Traverse level")
     parser.add_argument('--header', dest='dump_header', default=False, action='store_true', help="Output kernel header")
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile into projectdepends.profile under SynoBase, summary is printed to stderr')
     parser.add_argument('listProj', nargs='*', type=str, help='Replace project list')
     return parser.parse_args()
 
@@ -228,7 +228,7 @@ def ParseArgs():
 def loadConfigFiles(config):
     dictDepends = config.project_depends
 
-    confList = glob.glob(ScriptDir + "/../source/*/SynoBuildConf/depends*")
+    confList = sorted(glob.glob(ScriptDir + "/../source/*/SynoBuildConf/depends*"))
     for confPath in confList:
         project = confPath.split('/')[-3]
         filename = confPath.split('/')[-1]
@@ -239,8 +239,8 @@ def loadConfigFiles(config):
             depends = DependsParser(confPath)
             if project not in dictDepends:
                 dictDepends[project] = []
-            dictDepends[project] = list(set(dictDepends[project] + depends.build_dep))
-            dictDepends[project] = list(set(dictDepends[project] + depends.build_tag))
+            dictDepends[project] = list(dict.fromkeys(dictDepends[project] + depends.build_dep))
+            dictDepends[project] = list(dict.fromkeys(dictDepends[project] + depends.build_tag))
 
     return dictDepends
 
@@ -257,6 +257,8 @@ if __name__ == "__main__":
     level = -1
 
     dictArgs = ParseArgs()
+    if dictArgs.profile:
+        profiler.enable(os.path.join(BuildEnv.SynoBase, 'projectdepends.profile'))
 
     if dictArgs.level >= 0 and dictArgs.r_level >= 0:
         raise RuntimeError("Error! x and r can not use simultaneously")
@@ -284,7 +286,11 @@ if __name__ == "__main__":
         blAddKernelHeader, normalizedProjList = normalizeProjects(listProjs, config, kernels)
         replaceVariableSection(config, dictDepends)
         depGraph = DepGraph(dictDepends, level, direct)
-        listOut = depGraph.traverseDepends(normalizedProjList)
+        try:
+            listOut = depGraph.traverseDepends(normalizedProjList)
+        except DependencyError as e:
+            e.dumpCircluarDepList()
+            sys.exit(1)
 
         # reorder need filter while args not contain 'x' and 'r'
         if dictArgs.level == -1 and dictArgs.r_level == -1:
@@ -1,6 +1,8 @@
 #!/bin/bash
 # Copyright (c) 2000-2016 Synology Inc. All rights reserved.
 
+. "$(dirname "$(readlink -f "${BASH_SOURCE[0]}")")/codec"
+
 pkg_warn() {
 	local ret=$?
 	echo "Error: $@" >&2
@@ -262,9 +264,7 @@ pkg_dump_info() {
 }
 
 pkg_get_tar_option() {
-	local version_file="/PkgVersion"
-
-	echo "cJf"
+	echo "$(CodecTarOption "$PackageCodec") -cf"
 }
 
 pkg_make_package() { # <source path> <dest path>
@@ -276,7 +276,6 @@ pkg_make_inner_tarball() { # <source path> <dest path>
 	local package_name="package.tgz"
 	local temp_extractsize="extractsize_tmp"
 	local pkg_size=
-	local tar_option="$(pkg_get_tar_option)"
 
 	# check parameters
 	if [ -z "$source_path" -o ! -d "$source_path" ]; then
@@ -288,11 +287,15 @@ pkg_make_inner_tarball() { # <source path> <dest path>
 		return 1
 	fi
 
-	# add extractsize to INFO
-	pkg_size=`du -sk "$source_path" | awk '{print $1}'`
+	# add extractsize to INFO, allocated blocks of files just written are not stable
+	if [ -n "$SOURCE_DATE_EPOCH" ]; then
+		pkg_size=`du -sk --apparent-size "$source_path" | awk '{print $1}'`
+	else
+		pkg_size=`du -sk "$source_path" | awk '{print $1}'`
+	fi
 	echo "${pkg_size}" >> "$dest_path/$temp_extractsize"
-	echo ls $source_path \| tar $tar_option "$dest_path/$package_name" -C "$source_path" -T /dev/stdin
-	ls $source_path | tar $tar_option "$dest_path/$package_name" -C "$source_path" -T /dev/stdin
+	echo ls $source_path \| CodecTarCreate "$PackageCodec" "$dest_path/$package_name" -C "$source_path" -T /dev/stdin
+	ls $source_path | CodecTarCreate "$PackageCodec" "$dest_path/$package_name" -C "$source_path" -T /dev/stdin
 }
 
 __get_spk_name() { #<info path>
@@ -346,7 +349,6 @@ pkg_get_spk_family_name() { #<info path> [package name]
 }
 
 pkg_make_spk() { # <source path> <dest path> <spk file name>
-	local pack="tar cf"
 	local source_path=$1
 	local dest_path=$2
 	local info_path="$source_path/INFO"
@@ -376,13 +378,17 @@ pkg_make_spk() { # <source path> <dest path> <spk file name>
 	rm "$source_path/$temp_extractsize"
 
 	echo toolkit_version=$DSM_BUILD_NUM >> $info_path
-	echo "create_time=\"$(date +%Y%m%d-%T)\"" >> $info_path
+	if [ -n "$SOURCE_DATE_EPOCH" ]; then
+		echo "create_time=\"$(date -u -d "@$SOURCE_DATE_EPOCH" +%Y%m%d-%T)\"" >> $info_path
+	else
+		echo "create_time=\"$(date +%Y%m%d-%T)\"" >> $info_path
+	fi
 
 	# tar .spk file
 	pkg_log "creating package: $spk_name"
 	pkg_log "source:           $source_path"
 	pkg_log "destination:      $dest_path/$spk_name"
-	$pack "$dest_path/$spk_name" -C "$source_path" $(ls $source_path)
+	CodecTarCreate none "$dest_path/$spk_name" -C "$source_path" $(ls $source_path)
 }
 
 [ "$(caller)" != "0 NULL" ] && return 0
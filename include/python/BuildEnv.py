@@ -3,6 +3,8 @@
 import os
 import subprocess
 
+from cache import cache
+
 ScriptDir = os.path.realpath(os.path.dirname(__file__) + '/../../')
 SynoBase = os.path.dirname(ScriptDir)
 Prefix = os.path.dirname(SynoBase)
@@ -95,6 +97,7 @@ class DpkgNotFoundError(RuntimeError):
         print("Deb %s not found" % deb_name)
 
 
+@cache(mtime=lambda include_file, variable: os.path.join(ScriptDir, 'include', include_file))
 def getIncludeVariable(include_file, variable):
     return subprocess.check_output('source %s/include/%s; echo $%s' % (ScriptDir, include_file, variable),
                                    shell=True, executable='/bin/bash').decode().strip()
@@ -1,11 +1,158 @@
+import os
+import sys
+import time
+import atexit
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
 
-class cache(dict):
-    def __init__(self, func):
+# Memoization decorator shared by the scripts.
+#
+#   @cache                                   unbounded, keyed by positional arguments
+#   @cache(maxsize=128)                      least recently used entries are dropped
+#   @cache(ttl=60)                           entries expire after 60 seconds
+#   @cache(key=lambda path, *_: path)        custom key of the arguments
+#   @cache(mtime=lambda path: path)          entry is invalid once any returned file changes
+#   @cache(persist='/path/file.pickle')      entries are loaded from and saved to the file
+#
+# Set PKGSCRIPTS_CACHE_STATS=1 to print hit/miss counters at exit.
+
+_caches = []
+
+
+class Memoize:
+    def __init__(self, func, maxsize=None, ttl=None, key=None, mtime=None, persist=None):
         self.func = func
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.mtime = mtime
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.RLock()
+        self.__loaded = False
+        self.__doc__ = func.__doc__
+        self.__name__ = getattr(func, '__name__', repr(func))
+        _caches.append(self)
+
+    def __get_key(self, args, kwargs):
+        if self.key:
+            return self.key(*args, **kwargs)
+
+        if kwargs:
+            return args + tuple(sorted(kwargs.items()))
+        return args
+
+    def __get_mtimes(self, args, kwargs):
+        if not self.mtime:
+            return None
+
+        files = self.mtime(*args, **kwargs)
+        if isinstance(files, str):
+            files = [files]
+
+        mtimes = []
+        for f in files:
+            try:
+                mtimes.append(os.stat(f).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
 
-    def __call__(self, *args):
-        return self[args]
+        return tuple(mtimes)
+
+    def __is_valid(self, entry, mtimes):
+        _, created, entry_mtimes = entry
+        if self.ttl is not None and time.time() - created > self.ttl:
+            return False
+
+        return entry_mtimes == mtimes
+
+    def __call__(self, *args, **kwargs):
+        key = self.__get_key(args, kwargs)
+        mtimes = self.__get_mtimes(args, kwargs)
+
+        with self.__lock:
+            self.__load()
+            entry = self.__entries.get(key)
+            if entry is not None and self.__is_valid(entry, mtimes):
+                self.hits += 1
+                self.__entries.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+
+        result = self.func(*args, **kwargs)
+
+        with self.__lock:
+            self.__entries[key] = (result, time.time(), mtimes)
+            self.__entries.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self.__entries) > self.maxsize:
+                    self.__entries.popitem(last=False)
 
-    def __missing__(self, key):
-        result = self[key] = self.func(*key)
         return result
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __load(self):
+        if self.__loaded or not self.persist:
+            return
+
+        self.__loaded = True
+        try:
+            with open(self.persist, 'rb') as fd:
+                self.__entries.update(pickle.load(fd))
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    def save(self):
+        if not self.persist or not self.__entries:
+            return
+
+        with self.__lock:
+            try:
+                fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.persist)))
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(self.__entries, f)
+                os.replace(tmp_file, self.persist)
+            except (IOError, OSError, pickle.PicklingError):
+                pass
+
+    def stats(self):
+        return "%s: %d hits, %d misses, %d entries" % (self.__name__, self.hits, self.misses, len(self.__entries))
+
+
+def cache(func=None, **options):
+    if func is None:
+        return lambda func: Memoize(func, **options)
+
+    return Memoize(func, **options)
+
+
+def dump_stats(fd=None):
+    fd = fd or sys.stderr
+    for memoize in _caches:
+        if memoize.hits or memoize.misses:
+            fd.write("[cache] " + memoize.stats() + "\n")
+
+
+# forked workers exit without atexit handlers, only the main process saves
+def __at_exit():
+    for memoize in _caches:
+        memoize.save()
+
+    if os.environ.get('PKGSCRIPTS_CACHE_STATS'):
+        dump_stats()
+
+
+atexit.register(__at_exit)
@@ -1,5 +1,7 @@
 import os
+import signal
 import subprocess
+import time
 
 
 class Chroot:
@@ -40,3 +42,45 @@ class Chroot:
 
     def get_inside_path(self, path):
         return path.replace(self.chroot, "")
+
+
+def get_chroot_pids(chroot):
+    pids = []
+    chroot = os.path.realpath(chroot)
+
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            root = os.readlink(os.path.join('/proc', pid, 'root'))
+        except OSError:
+            continue
+        if root == chroot or root.startswith(chroot + '/'):
+            pids.append(int(pid))
+
+    return pids
+
+
+# Kill every process running inside the chroot and umount its /proc.
+def kill_chroot_processes(chroot, timeout=10):
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        pids = get_chroot_pids(chroot)
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+        deadline = time.time() + timeout
+        while pids and time.time() < deadline:
+            time.sleep(0.1)
+            pids = get_chroot_pids(chroot)
+
+        if not pids:
+            break
+
+    mount_point = os.path.join(chroot, 'proc')
+    if os.path.ismount(mount_point):
+        for cmd in [['umount', mount_point], ['umount', '-l', mount_point]]:
+            if subprocess.call(cmd) == 0:
+                break
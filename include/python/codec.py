@@ -0,0 +1,120 @@
+import os
+import shutil
+import subprocess
+
+# Compression codec of tarballs, the same spec is used by include/codec:
+#   <name>[:<level>[:<threads>]]
+#   name: xz, zstd or none. threads 0 is one per core, no level or threads is the tool default.
+#   gzip is only known to detect existing archives.
+# Archives keep their names (.txz), the codec of an existing file is detected by its magic.
+
+Magics = [
+    ('xz', b'\xfd7zXZ\x00'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+    ('gzip', b'\x1f\x8b'),
+]
+
+
+class CodecError(RuntimeError):
+    pass
+
+
+class Codec:
+    Names = ['xz', 'zstd', 'none', 'gzip']
+
+    def __init__(self, spec):
+        fields = spec.split(':')
+        self.name = fields[0]
+        self.level = fields[1] if len(fields) > 1 and fields[1] else None
+        self.threads = fields[2] if len(fields) > 2 and fields[2] else None
+        if self.name not in self.Names:
+            raise CodecError("Unknown codec: " + spec)
+
+    @property
+    def spec(self):
+        return ":".join(_ for _ in [self.name, self.level, self.threads] if _ is not None)
+
+    def __str__(self):
+        return self.spec
+
+    @property
+    def program(self):
+        if self.name == 'none':
+            return None
+
+        return self.name
+
+    def available(self):
+        return self.program is None or shutil.which(self.program) is not None
+
+    @property
+    def compress_cmd(self):
+        if self.name == 'none':
+            return None
+
+        cmd = [self.program]
+        if self.level is not None:
+            cmd.append('-' + self.level)
+        if self.threads is not None and self.name != 'gzip':
+            cmd.append('-T' + self.threads)
+        return cmd + ['-c']
+
+    @property
+    def decompress_cmd(self):
+        if self.name == 'none':
+            return None
+
+        cmd = [self.program, '-d', '-c']
+        if self.threads is not None and self.name == 'xz':
+            cmd.append('-T' + self.threads)
+        return cmd
+
+    # tar -I option, pixz extracts xz in parallel when installed
+    def get_tar_program(self):
+        if self.name == 'xz' and shutil.which('pixz'):
+            return 'pixz'
+
+        return self.program
+
+    def compress(self, src, dest):
+        self.__pipe(self.compress_cmd, src, dest)
+
+    def decompress(self, src, dest):
+        self.__pipe(self.decompress_cmd, src, dest)
+
+    def __pipe(self, cmd, src, dest):
+        with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+            if cmd is None:
+                shutil.copyfileobj(fin, fout, 1024 * 1024)
+                return
+
+            if subprocess.call(cmd, stdin=fin, stdout=fout) != 0:
+                raise CodecError("%s failed on %s" % (" ".join(cmd), src))
+
+
+def detect_codec(path):
+    with open(path, 'rb') as fd:
+        head = fd.read(8)
+
+    for name, magic in Magics:
+        if head.startswith(magic):
+            return Codec(name)
+
+    return Codec('none')
+
+
+def get_tar_extract_option(path):
+    program = detect_codec(path).get_tar_program()
+    if not program:
+        return []
+
+    return ['-I' + program]
+
+
+def get_default_codec(kind):
+    env, default = {
+        'intermediate': ('PKG_INTERMEDIATE_CODEC', 'xz:0:0'),
+        'package': ('PKG_PACKAGE_CODEC', 'xz'),
+    }[kind]
+
+    return Codec(os.environ.get(env) or default)
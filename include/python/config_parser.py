@@ -2,6 +2,8 @@ import os
 import configparser
 from collections import defaultdict
 
+from cache import cache
+
 
 class ConfigNotFoundError(RuntimeError):
     pass
@@ -14,24 +16,41 @@ def remove_quote(string):
     return string.strip('"').strip("'")
 
 
+# Parsed files are shared by all parsers of the same path until the file changes, do not modify them.
+@cache(maxsize=1024, mtime=lambda config: config)
+def read_config(config):
+    parser = configparser.ConfigParser(allow_no_value=True)
+    parser.optionxform = str
+    parser.read(config)
+    return parser
+
+
+@cache(maxsize=1024, mtime=lambda f: f)
+def read_key_value(f):
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    with open(f, 'r', encoding='utf-8') as fd:
+        config.read_string('[top]\n' + fd.read())
+    return dict(config['top'])
+
+
 class ConfigParser():
     def __init__(self, config):
         if not os.path.isfile(config):
             raise ConfigNotFoundError(config)
 
-        self.config = configparser.ConfigParser(allow_no_value=True)
-        self.config.optionxform = str
-        self.config.read(config)
+        self.config = read_config(config)
 
+    # duplicates are dropped in the order of the file, a set would reorder them on every run
     def _get_section_keys(self, section):
         if self.config.has_section(section):
-            return list(set(map(remove_quote, self.config[section].keys())))
+            return list(dict.fromkeys(map(remove_quote, self.config[section].keys())))
         else:
             return []
 
     def _get_section_values(self, section):
         if self.config.has_section(section):
-            return list(set(map(remove_quote, self.config[section].values())))
+            return list(dict.fromkeys(map(remove_quote, self.config[section].values())))
         else:
             return []
 
@@ -151,11 +170,7 @@ class KeyValueParser():
         if not os.path.isfile(f):
             raise ConfigNotFoundError(f)
 
-        config = configparser.ConfigParser()
-        config.optionxform = str
-        with open(f, 'r', encoding='utf-8') as fd:
-            config.read_string('[top]\n' + fd.read())
-        self.config = dict(config['top'])
+        self.config = read_key_value(f)
 
     def __getitem__(self, key):
         return remove_quote(self.config[key])
@@ -0,0 +1,218 @@
+import os
+import shlex
+import threading
+import subprocess
+
+from chroot import Chroot, kill_chroot_processes
+from resource_usage import ResourceSampler
+from watchdog import Watchdog
+
+# Executors run a shell command inside the chroot of a platform.
+# LocalExecutor enters the chroot on this machine. SshExecutor runs it on a worker host which has
+# the toolkit deployed under remote_base: files are pushed/pulled with rsync and the output
+# is streamed back into the local log while the command runs.
+
+LocalHost = 'local'
+
+# kill processes whose root is in the chroot of $1 on a worker host, see chroot.kill_chroot_processes
+KillChrootScript = '''
+chroot=$(readlink -f "$1")
+for sig in TERM KILL; do
+    for i in $(seq 100); do
+        pids=
+        for root in /proc/[0-9]*/root; do
+            case "$(readlink "$root")" in
+            "$chroot"|"$chroot"/*) pid=${root#/proc/}; pids="$pids ${pid%/root}" ;;
+            esac
+        done
+        [ -z "$pids" ] && break 2
+        [ "$i" = 1 ] && kill -$sig $pids 2>/dev/null
+        sleep 0.1
+    done
+done
+umount "$chroot/proc" 2>/dev/null || umount -l "$chroot/proc" 2>/dev/null
+true
+'''
+
+
+class ExecutorError(RuntimeError):
+    pass
+
+
+class LocalExecutor:
+    host = LocalHost
+
+    def __init__(self, chroot_class=Chroot):
+        self.chroot_class = chroot_class
+
+    # project logs of the stage log logs.<type> are logs/<proj>.<type>
+    def run(self, chroot, cmd, log, sample_interval=0, timeouts=None, cgroup=None):
+        log_type = os.path.basename(log).partition('.')[2]
+        if cgroup:
+            try:
+                cgroup.create()
+            except (IOError, OSError) as e:
+                raise ExecutorError("Failed to create cgroup %s: %s" % (cgroup.path, str(e)))
+
+        try:
+            with self.chroot_class(chroot):
+                with open(os.devnull, 'wb') as null:
+                    pipe = subprocess.Popen(cmd, stdout=null, shell=True, executable='/bin/bash',
+                                            preexec_fn=cgroup.attach if cgroup else None)
+                    with ResourceSampler(pipe.pid, sample_interval, log_type) as sampler, \
+                            Watchdog(pipe.pid, timeouts):
+                        pipe.wait()
+        finally:
+            if cgroup:
+                cgroup.remove()
+
+        # the raw series is written next to the log
+        if sample_interval > 0:
+            sampler.write_series(log + '.usage')
+
+        return pipe.returncode, sampler.summary()
+
+    def check_output(self, chroot, cmd):
+        with self.chroot_class(chroot):
+            return subprocess.check_output(cmd, shell=True, executable='/bin/bash').decode()
+
+    def cancel(self, chroot):
+        kill_chroot_processes(chroot)
+
+    def run_host(self, cmd, log=None):
+        return subprocess.call(cmd, shell=True, executable='/bin/bash')
+
+    def push(self, chroot, paths, keep=()):
+        pass
+
+    def pull(self, chroot, paths):
+        pass
+
+
+class SshExecutor:
+    def __init__(self, host, local_base, remote_base=None, ssh='ssh', rsync='rsync'):
+        self.host = host
+        self.local_base = os.path.realpath(local_base)
+        self.remote_base = remote_base or self.local_base
+        self.ssh = shlex.split(ssh)
+        self.rsync = shlex.split(rsync)
+
+    def get_remote_path(self, path):
+        path = os.path.realpath(path)
+        if path != self.local_base and not path.startswith(self.local_base + '/'):
+            raise ExecutorError("%s is not under %s" % (path, self.local_base))
+
+        return self.remote_base + path[len(self.local_base):]
+
+    def __wrap_chroot(self, chroot, cmd):
+        proc = shlex.quote(os.path.join(chroot, 'proc'))
+        return ('mountpoint -q {proc} || mount -t proc none {proc}; chroot {chroot} /bin/bash -c {cmd}; '
+                'ret=$?; umount {proc} 2>/dev/null; exit $ret').format(
+                    proc=proc, chroot=shlex.quote(chroot), cmd=shlex.quote(cmd))
+
+    def __ssh(self, cmd):
+        return self.ssh + [self.host, cmd]
+
+    # output is appended to log line by line, so the log can be followed while building
+    def run_host(self, cmd, log=None):
+        if not log:
+            return subprocess.call(self.__ssh(cmd))
+
+        with open(log, 'ab') as fd:
+            pipe = subprocess.Popen(self.__ssh(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for line in pipe.stdout:
+                fd.write(line)
+                fd.flush()
+            return pipe.wait()
+
+    # processes on the host can not be inspected, only the stage timeout applies by killing the chroot
+    # processes on the host and hanging up ssh, cgroups of the host are not managed either
+    def run(self, chroot, cmd, log, sample_interval=0, timeouts=None, cgroup=None):
+        if not timeouts or not timeouts.stage:
+            return self.run_host(self.__wrap_chroot(self.get_remote_path(chroot), cmd), log), None
+
+        with open(log, 'ab') as fd:
+            pipe = subprocess.Popen(self.__ssh(self.__wrap_chroot(self.get_remote_path(chroot), cmd)),
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            expired = []
+
+            # the remote command goes on without its ssh client
+            def hang_up():
+                expired.append(True)
+                self.cancel(chroot)
+                pipe.terminate()
+
+            timer = threading.Timer(timeouts.stage, hang_up)
+            timer.start()
+            try:
+                for line in pipe.stdout:
+                    fd.write(line)
+                    fd.flush()
+                returncode = pipe.wait()
+            finally:
+                timer.cancel()
+
+            if expired:
+                message = "[WATCHDOG] Stage timeout after %ds on %s, ssh is hung up." % (timeouts.stage, self.host)
+                print(message)
+                fd.write((message + "\n").encode())
+
+        return returncode, None
+
+    def check_output(self, chroot, cmd):
+        return subprocess.check_output(self.__ssh(self.__wrap_chroot(self.get_remote_path(chroot), cmd))).decode()
+
+    def cancel(self, chroot):
+        cmd = "bash -c %s kill-chroot %s" % (shlex.quote(KillChrootScript), shlex.quote(self.get_remote_path(chroot)))
+        with open(os.devnull, 'wb') as null:
+            if subprocess.call(self.__ssh(cmd), stdout=null) != 0:
+                print("[WARNING] Failed to kill processes in %s on %s" % (chroot, self.host))
+
+    def __rsync(self, src, dest, delete=True):
+        cmd = self.rsync + ['-a'] + (['--delete'] if delete else []) + ['--ignore-missing-args', src, dest]
+        with open(os.devnull, 'wb') as null:
+            if subprocess.call(cmd, stdout=null) != 0:
+                raise ExecutorError("Failed to sync %s -> %s" % (src, dest))
+
+    # remote files missing locally are deleted, except under paths in keep, e.g. build output in source
+    def push(self, chroot, paths, keep=()):
+        remote_chroot = self.get_remote_path(chroot)
+        dirs = set(os.path.dirname(os.path.join(remote_chroot, _)) for _ in paths)
+        self.run_host("mkdir -p " + " ".join(map(shlex.quote, sorted(dirs))))
+
+        for path in paths:
+            local = os.path.join(chroot, path)
+            if os.path.isdir(local):
+                self.__rsync(local + '/', '%s:%s/' % (self.host, os.path.join(remote_chroot, path)),
+                             delete=path not in keep)
+            elif os.path.exists(local):
+                self.__rsync(local, '%s:%s' % (self.host, os.path.join(remote_chroot, path)))
+
+    # paths missing on the host are skipped
+    def pull(self, chroot, paths):
+        remote_chroot = self.get_remote_path(chroot)
+        for path in paths:
+            local = os.path.join(chroot, path)
+            if not os.path.isdir(os.path.dirname(local)):
+                os.makedirs(os.path.dirname(local))
+            self.__rsync('%s:%s' % (self.host, os.path.join(remote_chroot, path)), os.path.dirname(local) + '/')
+
+
+def parse_hosts(hosts):
+    # "user@host1:4 host2" -> {'user@host1': 4, 'host2': 1}
+    slots = dict()
+    for host in hosts.split():
+        if ':' in host and host.rsplit(':', 1)[1].isdigit():
+            host, count = host.rsplit(':', 1)
+            slots[host] = int(count)
+        else:
+            slots[host] = 1
+
+    return slots
+
+
+def new_executor(host, local_base, remote_base=None, chroot_class=Chroot):
+    if not host or host == LocalHost:
+        return LocalExecutor(chroot_class)
+
+    return SshExecutor(host, local_base, remote_base)
@@ -0,0 +1,195 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from abc import ABC, abstractmethod
+from fnmatch import fnmatch
+
+# Watch directory trees for changed files. inotify is used through libc, a polling
+# scan of mtimes is used when it is not available (e.g. watch limit reached).
+#
+#   watcher = new_watcher(dirs)
+#   changed = watcher.wait()    # blocks until changes settle, returns changed paths
+
+IgnorePatterns = ['.git', '.svn', '*.swp', '*.swx', '*~', '.#*', '4913']
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WatchMask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EventHeader = struct.Struct('iIII')
+
+
+def is_ignored(path):
+    return any(fnmatch(os.path.basename(path), _) for _ in IgnorePatterns)
+
+
+def walk_dirs(root):
+    for dirpath, dirs, _ in os.walk(root):
+        dirs[:] = [d for d in dirs if not is_ignored(d)]
+        yield dirpath
+
+
+class FileWatcher(ABC):
+    def __init__(self, roots, debounce=0.5):
+        self.roots = roots
+        self.debounce = debounce
+
+    # changes are collected until nothing changes for debounce seconds, editors write in several steps
+    def wait(self):
+        changed = set()
+        while not changed:
+            changed = self._read(None)
+
+        while True:
+            more = self._read(self.debounce)
+            if not more:
+                break
+            changed |= more
+
+        return sorted(changed)
+
+    # changed paths within timeout seconds, None waits for the first change
+    @abstractmethod
+    def _read(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(FileWatcher):
+    def __init__(self, roots, debounce=0.5):
+        FileWatcher.__init__(self, roots, debounce)
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1: " + os.strerror(ctypes.get_errno()))
+        self.__dirs = dict()
+
+        try:
+            for root in roots:
+                self.__add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def __add_tree(self, root):
+        added = []
+        for path in walk_dirs(root):
+            wd = self.__libc.inotify_add_watch(self.__fd, path.encode(), WatchMask)
+            if wd < 0:
+                err = ctypes.get_errno()
+                # the dir may be gone already, out of watches is fatal
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    continue
+                raise OSError(err, "inotify_add_watch %s: %s" % (path, os.strerror(err)))
+            self.__dirs[wd] = path
+            added.append(path)
+
+        return added
+
+    def _read(self, timeout):
+        readable, _, _ = select.select([self.__fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        try:
+            data = os.read(self.__fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EventHeader.unpack_from(data, offset)
+            offset += EventHeader.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events are lost, report every watched dir
+                changed.update(self.__dirs.values())
+                continue
+
+            if mask & IN_IGNORED:
+                self.__dirs.pop(wd, None)
+                continue
+
+            if wd not in self.__dirs or (name and is_ignored(name)):
+                continue
+
+            path = os.path.join(self.__dirs[wd], name) if name else self.__dirs[wd]
+            changed.add(path)
+
+            # files of a new dir may be written before its watch is added
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                for dirpath in self.__add_tree(path):
+                    changed.update(os.path.join(dirpath, f) for f in os.listdir(dirpath))
+
+        return changed
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+
+class PollingWatcher(FileWatcher):
+    def __init__(self, roots, debounce=0.5, interval=1.0):
+        FileWatcher.__init__(self, roots, debounce)
+        self.interval = interval
+        self.__snapshot = self.__scan()
+
+    def __scan(self):
+        snapshot = dict()
+        for root in self.roots:
+            for dirpath in walk_dirs(root):
+                try:
+                    names = os.listdir(dirpath)
+                except OSError:
+                    continue
+                for name in names:
+                    if is_ignored(name):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.lstat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size, stat.st_mode)
+
+        return snapshot
+
+    def _read(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.time())))
+            snapshot = self.__scan()
+            changed = set(path for path in set(snapshot) | set(self.__snapshot)
+                          if snapshot.get(path) != self.__snapshot.get(path))
+            self.__snapshot = snapshot
+
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+
+def new_watcher(roots, debounce=0.5):
+    try:
+        return InotifyWatcher(roots, debounce)
+    except (OSError, AttributeError) as e:
+        print("[WARNING] inotify not available (%s), poll for changes instead." % str(e))
+        return PollingWatcher(roots, debounce)
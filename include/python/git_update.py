@@ -0,0 +1,144 @@
+import os
+import fcntl
+import threading
+import subprocess
+import multiprocessing.pool
+from collections import defaultdict
+
+import BuildEnv
+from project_visitor import UpdateHook, UpdateFailedError
+
+ErrorLog = os.path.join(BuildEnv.SynoBase, 'logs', 'error.update')
+
+# State of this process shared by all hooks: fetched mirrors, checked out ref of each
+# project and a lock per path as traversals of several versions run in threads.
+_fetched = set()
+_checkouts = dict()
+_path_locks = defaultdict(threading.Lock)
+_state_lock = threading.Lock()
+# errors of all traversals are appended, the log of a previous run is truncated on first write
+_error_log_lock = threading.Lock()
+_error_log_written = False
+
+
+def get_path_lock(path):
+    with _state_lock:
+        return _path_locks[path]
+
+
+def write_error_log(errors):
+    global _error_log_written
+    with _error_log_lock:
+        os.makedirs(os.path.dirname(ErrorLog), exist_ok=True)
+        with open(ErrorLog, 'a' if _error_log_written else 'w') as fd:
+            fd.write("\n".join(errors) + "\n")
+        _error_log_written = True
+
+
+def run_git(*args):
+    try:
+        subprocess.check_output(['git'] + list(args), stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        raise UpdateFailedError("git %s\n%s" % (" ".join(args), e.output.decode(errors='replace')))
+
+
+# Projects are cloned from a local bare mirror of the remote, so clones are local and
+# only the mirror talks to the remote with incremental fetches.
+# remote is an url or path, "{project}" is replaced by project name, "<remote>/<project>.git" otherwise.
+class GitUpdateHook(UpdateHook):
+    def __init__(self, remote, mirror_dir, branch, build_num, tag_format='{build_num}', jobs=8):
+        self.remote = remote
+        self.mirror_dir = mirror_dir
+        self.branch = branch
+        self.build_num = build_num
+        self.tag = tag_format.format(build_num=build_num, branch=branch)
+        self.jobs = jobs
+
+    @property
+    def checkout_key(self):
+        return (self.branch, self.tag)
+
+    def update_tag(self, projects):
+        self.__update(projects, 'refs/tags/' + self.tag, detach=True)
+
+    def update_branch(self, projects):
+        self.__update(projects, self.branch)
+
+    def get_remote_url(self, proj):
+        if '{project}' in self.remote:
+            return self.remote.format(project=proj)
+
+        return self.remote.rstrip('/') + '/' + proj + '.git'
+
+    def get_mirror(self, proj):
+        return os.path.join(self.mirror_dir, proj + '.git')
+
+    def __update(self, projects, ref, detach=False):
+        projects = sorted(set(map(BuildEnv.deVirtual, projects)))
+        if not projects:
+            return
+
+        pool = multiprocessing.pool.ThreadPool(processes=min(self.jobs, len(projects)))
+        try:
+            results = pool.map(lambda proj: self.__update_project(proj, ref, detach), projects)
+        finally:
+            pool.close()
+            pool.join()
+
+        errors = [_ for _ in results if _]
+        if errors:
+            write_error_log(errors)
+            raise UpdateFailedError("Failed to update: " + " ".join(p for p, e in zip(projects, results) if e))
+
+    def __update_project(self, proj, ref, detach):
+        try:
+            mirror = self.__fetch_mirror(proj)
+            self.__checkout(proj, mirror, ref, detach)
+        except UpdateFailedError as e:
+            return "[%s] %s" % (proj, str(e))
+
+        print("[%s] Checkout %s" % (proj, ref))
+
+    def __fetch_mirror(self, proj):
+        mirror = self.get_mirror(proj)
+        os.makedirs(self.mirror_dir, exist_ok=True)
+
+        # mirror dir may be shared by concurrent PkgCreate, lockf only excludes other processes
+        with get_path_lock(mirror), open(mirror + '.lock', 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            if mirror in _fetched:
+                return mirror
+
+            if os.path.isdir(mirror):
+                run_git('-C', mirror, 'fetch', '--prune', 'origin')
+            else:
+                tmp_mirror = mirror + '.tmp'
+                if os.path.isdir(tmp_mirror):
+                    subprocess.call(['rm', '-rf', tmp_mirror])
+                run_git('clone', '--mirror', self.get_remote_url(proj), tmp_mirror)
+                os.rename(tmp_mirror, mirror)
+
+            _fetched.add(mirror)
+
+        return mirror
+
+    def __checkout(self, proj, mirror, ref, detach):
+        proj_dir = os.path.join(BuildEnv.SourceDir, proj)
+        with get_path_lock(proj_dir):
+            if _checkouts.get(proj_dir) != ref:
+                self.__checkout_project(proj_dir, mirror, ref, detach)
+                _checkouts[proj_dir] = ref
+
+    def __checkout_project(self, proj_dir, mirror, ref, detach):
+        if not os.path.isdir(os.path.join(proj_dir, '.git')):
+            if os.path.exists(proj_dir):
+                raise UpdateFailedError("%s exists but is not a git repository" % proj_dir)
+            run_git('clone', '--no-checkout', mirror, proj_dir)
+        else:
+            run_git('-C', proj_dir, 'fetch', '--prune', '--tags', mirror,
+                    '+refs/heads/*:refs/remotes/origin/*')
+
+        if detach:
+            run_git('-C', proj_dir, 'checkout', '-q', '-f', '--detach', ref)
+        else:
+            run_git('-C', proj_dir, 'checkout', '-q', '-f', '-B', ref, 'refs/remotes/origin/' + ref)
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import hashlib
+import subprocess
+
+# Journal of completed stages, one JSON object per line:
+#   {"time": ..., "platform": "x64", "stage": "Build Package", "fingerprint": "...", "status": "done"}
+# Lines are appended with O_APPEND by a single write, so pool workers of the same or concurrent
+# runs never interleave a record. A stage is done when its latest record with the current
+# fingerprint of the platform says so.
+
+
+class RunJournal:
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, platform, stage, fingerprint, status):
+        record = json.dumps({'time': int(time.time()), 'platform': platform, 'stage': stage,
+                             'fingerprint': fingerprint, 'status': status}, sort_keys=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (record + "\n").encode())
+        finally:
+            os.close(fd)
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'r') as fd:
+            for line in fd:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a run killed while writing leaves a partial last line
+                    continue
+
+    def get_done_stages(self, fingerprints):
+        status = dict()
+        for record in self.read():
+            platform = record.get('platform')
+            if platform in fingerprints and record.get('fingerprint') == fingerprints[platform]:
+                status[(platform, record.get('stage'))] = record.get('status')
+
+        done = dict()
+        for (platform, stage), value in status.items():
+            if value == 'done':
+                done.setdefault(platform, set()).add(stage)
+
+        return done
+
+
+def fingerprint(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def __git(path, *args, **kwargs):
+    with open(os.devnull, 'wb') as null:
+        return subprocess.check_output(['git', '-C', path] + list(args), stderr=null, **kwargs)
+
+
+# HEAD, uncommitted changes and untracked files of a git checkout, mtimes of the files otherwise
+def get_source_revision(path):
+    if not os.path.isdir(path):
+        return None
+
+    digest = hashlib.sha1()
+    try:
+        digest.update(__git(path, 'rev-parse', 'HEAD'))
+        digest.update(__git(path, 'diff', 'HEAD', '--binary'))
+        untracked = __git(path, '-c', 'core.quotePath=false', 'ls-files', '--others', '--exclude-standard')
+        digest.update(untracked)
+        if untracked:
+            digest.update(__git(path, 'hash-object', '--stdin-paths', input=untracked))
+        return digest.hexdigest()
+    except (subprocess.CalledProcessError, OSError):
+        pass
+
+    for dirpath, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            try:
+                stat = os.lstat(os.path.join(dirpath, f))
+            except OSError:
+                continue
+            digest.update(("%s %d %d\n" % (os.path.join(dirpath, f), stat.st_mtime_ns, stat.st_size)).encode())
+
+    return digest.hexdigest()
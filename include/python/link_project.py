@@ -42,6 +42,34 @@ def link_projects(projects, dest):
         link(get_project_source(proj), os.path.join(dest, 'source', proj))
 
 
+# Update a single changed path of a linked project, build output around it is kept.
+# Editors replacing files break the hard link, the new file is linked again.
+def relink_path(source, dest):
+    if os.path.isdir(source) and not os.path.islink(source):
+        if not os.path.exists(dest):
+            link(source, dest)
+        return
+
+    if os.path.lexists(source):
+        if os.path.lexists(dest) and not os.path.islink(source) and os.path.samefile(source, dest):
+            return
+
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        tmp_dest = dest + '.relink'
+        if os.path.lexists(tmp_dest):
+            os.remove(tmp_dest)
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), tmp_dest)
+        else:
+            os.link(source, tmp_dest)
+        os.replace(tmp_dest, dest)
+    elif os.path.isdir(dest) and not os.path.islink(dest):
+        shutil.rmtree(dest)
+    elif os.path.lexists(dest):
+        os.remove(dest)
+
+
 def link_platform(project, platform, version=None):
     source = get_project_source(project)
     chroot = BuildEnv.getChrootSynoBase(platform, version)
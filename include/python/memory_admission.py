@@ -0,0 +1,146 @@
+import os
+
+# Memory admission of platform tasks. Each platform is expected to need the peak RSS recorded by
+# previous runs, a task is held back while the expected peaks of running tasks plus its own
+# exceed the capacity, MemAvailable when the tasks are started if no limit is given.
+#
+# Optionally each SynoBuild/SynoInstall runs in its own cgroup v2 with memory.high, so a platform
+# exceeding its expectation is throttled and reclaimed instead of starving the others.
+
+
+class MemoryCgroupError(RuntimeError):
+    pass
+
+
+def get_mem_available():
+    with open('/proc/meminfo', 'r') as fd:
+        for line in fd:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+
+    return None
+
+
+class MemoryAdmission:
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.capacity = None
+        self.needs = dict()
+        self.__reserved = dict()
+        self.__held = set()
+
+    def start(self, needs):
+        self.needs = needs
+        self.capacity = self.limit or get_mem_available()
+        self.__reserved.clear()
+        self.__held.clear()
+
+    # at least one task runs, otherwise a task needing more than the capacity would never start
+    def admit(self, key):
+        need = self.needs.get(key) or 0
+        reserved = sum(self.__reserved.values())
+        if self.__reserved and reserved + need > self.capacity:
+            if key not in self.__held:
+                self.__held.add(key)
+                print("[%s] Hold back, expects %dM, %dM of %dM reserved by %s." % (
+                    key, need >> 20, reserved >> 20, self.capacity >> 20, " ".join(sorted(self.__reserved))))
+            return False
+
+        self.__reserved[key] = need
+        return True
+
+    def release(self, key):
+        self.__reserved.pop(key, None)
+
+
+def read_file(path):
+    with open(path, 'r') as fd:
+        return fd.read()
+
+
+def write_file(path, content):
+    with open(path, 'w') as fd:
+        fd.write(content)
+
+
+def get_cgroup2_mount():
+    with open('/proc/mounts', 'r') as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) > 2 and fields[2] == 'cgroup2':
+                return fields[1]
+
+    return None
+
+
+# cgroup v2 dir whose children get the memory controller, called once by the main process.
+# A cgroup with processes can not enable controllers for its children, so the process is moved
+# into a leaf first, e.g. when started by "systemd-run --scope -p Delegate=yes".
+def setup_memory_cgroup():
+    mount = get_cgroup2_mount()
+    if not mount:
+        raise MemoryCgroupError("cgroup v2 is not mounted")
+
+    path = None
+    for line in read_file('/proc/self/cgroup').split("\n"):
+        if line.startswith('0::'):
+            path = line[3:]
+    if path is None:
+        raise MemoryCgroupError("Process is not in a cgroup v2")
+
+    root = os.path.join(mount, path.lstrip('/'))
+    try:
+        if 'memory' not in read_file(os.path.join(root, 'cgroup.controllers')).split():
+            raise MemoryCgroupError("Memory controller is not available in %s" % root)
+
+        if 'memory' not in read_file(os.path.join(root, 'cgroup.subtree_control')).split():
+            if path != '/':
+                leaf = os.path.join(root, 'pkgcreate-%d' % os.getpid())
+                os.makedirs(leaf, exist_ok=True)
+                write_file(os.path.join(leaf, 'cgroup.procs'), str(os.getpid()))
+            write_file(os.path.join(root, 'cgroup.subtree_control'), '+memory')
+    except (IOError, OSError) as e:
+        raise MemoryCgroupError("Can not enable memory controller for children of %s: %s, run in a delegated "
+                                "cgroup without other processes" % (root, str(e)))
+
+    return root
+
+
+# cgroup of a single command, the command joins it between fork and exec, see attach()
+class MemoryCgroup:
+    def __init__(self, path, high):
+        self.path = path
+        self.high = high
+        self.__procs_fd = None
+
+    # the cgroup file system is not visible inside the chroot, it is opened before
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+        write_file(os.path.join(self.path, 'memory.high'), str(self.high))
+        self.__procs_fd = os.open(os.path.join(self.path, 'cgroup.procs'), os.O_WRONLY)
+
+    def attach(self):
+        os.write(self.__procs_fd, b'0')
+
+    def remove(self):
+        if self.__procs_fd is not None:
+            os.close(self.__procs_fd)
+            self.__procs_fd = None
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            print("[WARNING] Failed to remove cgroup %s: %s" % (self.path, str(e)))
+
+
+# memory.high of a platform is factor times its expected peak RSS
+class MemoryHighPolicy:
+    def __init__(self, root, factor):
+        self.root = root
+        self.factor = factor
+
+    def new_cgroup(self, platform, need):
+        if not need:
+            return None
+
+        return MemoryCgroup(os.path.join(self.root, 'pkgcreate-%d-%s' % (os.getpid(), platform)),
+                            int(need * self.factor))
@@ -0,0 +1,121 @@
+import os
+import glob
+import time
+
+# OpenMetrics textfile of a run, e.g. for the textfile collector of node_exporter.
+# Every family is a gauge of the last run, the unit is told by the suffix of its name.
+
+Units = ['bytes_per_second', 'seconds', 'bytes', 'ratio']
+
+RunFamilies = {
+    'run_duration_seconds': 'Wall time of the run',
+    'run_success': '1 if the run succeeded, otherwise 0',
+    'run_timestamp_seconds': 'Time the run finished',
+}
+
+# ccache 3 and 4 keep counters in <dir>/<hex>/stats, one per line
+CcacheCounters = {
+    'misses': 4,
+    'preprocessed_hits': 8,
+    'direct_hits': 22,
+}
+
+
+# families of the summary of ResourceSampler, what is e.g. "the stage on a platform"
+def usage_families(name, what):
+    return {
+        name + '_cpu_cores': 'Average busy cores of ' + what,
+        name + '_rss_peak_bytes': 'Peak RSS of ' + what,
+        name + '_read_bytes': 'Bytes read from storage by ' + what,
+        name + '_write_bytes': 'Bytes written to storage by ' + what,
+    }
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return "%d" % value
+
+
+def get_unit(name):
+    for unit in Units:
+        if name.endswith('_' + unit):
+            return unit
+
+
+class Metrics:
+    def __init__(self, prefix, families):
+        self.prefix = prefix
+        self.families = dict(RunFamilies, **families)
+        self.__samples = dict((_, dict()) for _ in self.families)
+
+    def add(self, name, value, **labels):
+        self.__samples[name][tuple(sorted(labels.items()))] = value
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.__samples[name][key] = self.__samples[name].get(key, 0) + value
+
+    def add_usage(self, name, summary, **labels):
+        if not summary:
+            return
+
+        self.add(name + '_cpu_cores', summary['cpu_avg'], **labels)
+        self.add(name + '_rss_peak_bytes', summary['rss_peak'], **labels)
+        self.add(name + '_read_bytes', summary['read_bytes'], **labels)
+        self.add(name + '_write_bytes', summary['write_bytes'], **labels)
+
+    def add_run(self, elapsed, succeeded, **labels):
+        self.add('run_duration_seconds', elapsed, **labels)
+        self.add('run_success', 1 if succeeded else 0, **labels)
+        self.add('run_timestamp_seconds', time.time(), **labels)
+
+    def format(self):
+        lines = []
+        for name, help in self.families.items():
+            if not self.__samples[name]:
+                continue
+
+            full_name = self.prefix + '_' + name
+            lines.append("# TYPE %s gauge" % full_name)
+            if get_unit(name):
+                lines.append("# UNIT %s %s" % (full_name, get_unit(name)))
+            lines.append("# HELP %s %s" % (full_name, help))
+            for labels, value in self.__samples[name].items():
+                label_str = ",".join('%s="%s"' % (k, escape_label(v)) for k, v in labels)
+                lines.append("%s%s %s" % (full_name, "{%s}" % label_str if label_str else "", format_value(value)))
+
+        return "\n".join(lines + ["# EOF"]) + "\n"
+
+    # collectors must never read a partial file
+    def write(self, path):
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            fd.write(self.format())
+        os.rename(tmp_path, path)
+
+
+# counters of ccache dirs under root zeroed since the time, None if ccache is not used
+def read_ccache_stats(root, since=0):
+    stats = dict((_, 0) for _ in CcacheCounters)
+    found = False
+    for path in glob.glob(os.path.join(root, '*', 'stats')) + glob.glob(os.path.join(root, '*', '?', 'stats')):
+        try:
+            if os.path.getmtime(path) < since:
+                continue
+            with open(path, 'r') as fd:
+                counters = [int(_) for _ in fd.read().split()]
+        except (IOError, OSError, ValueError):
+            continue
+
+        found = True
+        for key, index in CcacheCounters.items():
+            if index < len(counters):
+                stats[key] += counters[index]
+
+    return stats if found else None
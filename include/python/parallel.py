@@ -1,6 +1,43 @@
 import multiprocessing
+import multiprocessing.pool
+import queue
 import traceback
 
+import profiler
+
+__FailFast = False
+__CancelCleanup = None
+__PoolSize = None
+
+
+class ParallelCancelledError(RuntimeError):
+    def __init__(self, error, completed, failed, cancelled):
+        self.error = error
+        self.completed = completed
+        self.failed = failed
+        self.cancelled = cancelled
+        RuntimeError.__init__(self, str(error))
+
+    def summary(self):
+        msg = []
+        for title, items in [("Completed", self.completed), ("Failed", self.failed), ("Cancelled", self.cancelled)]:
+            msg.append("%-10s: %s" % (title, " ".join(map(str, items))))
+        return msg
+
+
+# Stop at the first failed task instead of waiting for all of them.
+# cleanup(keys) is called with the cancelled keys of doPlatformParallel after the pool is terminated.
+def setFailFast(enable, cleanup=None):
+    global __FailFast, __CancelCleanup
+    __FailFast = enable
+    __CancelCleanup = cleanup
+
+
+# Number of processes of doPlatformParallel, None is the number of CPUs.
+def setPoolSize(size):
+    global __PoolSize
+    __PoolSize = size
+
 
 class LogExceptions(object):
     def __init__(self, callable):
@@ -9,7 +46,7 @@ class LogExceptions(object):
 
     def __call__(self, *args, **kwargs):
         try:
-            result = self.__callable(*args, **kwargs)
+            result = profiler.run_task(self.__callable, *args, **kwargs)
 
         except Exception:
             print(traceback.format_exc())
@@ -18,22 +55,106 @@ class LogExceptions(object):
         return result
 
 
+def __waitAll(pool, results):
+    pool.close()
+    pool.join()
+
+    output = dict()
+    for key, result in results:
+        output[key] = result.get()
+
+    return output
+
+
+# done is a queue of keys of finished tasks, put by their callbacks.
+# A callback runs before its result is ready(), get() waits for the result instead.
+# held are keys of tasks never submitted, they are cancelled as well
+def __waitFailFast(pool, results, done, cleanup, held=()):
+    pool.close()
+    pending = dict(results)
+    output = dict()
+
+    while pending:
+        key = done.get()
+        result = pending.pop(key)
+
+        try:
+            output[key] = result.get()
+        except Exception as e:
+            pool.terminate()
+            pool.join()
+            cancelled = list(pending) + list(held)
+            if cleanup:
+                cleanup(cancelled)
+            raise ParallelCancelledError(e, list(output), [key], cancelled)
+
+    pool.join()
+    return output
+
+
+# Tasks are submitted in order as soon as admission admits them, later tasks may pass a held one.
+# released is a queue of keys of finished tasks like done of __waitFailFast, drained only here.
+# Returns tasks still held when a task failed in fail-fast mode.
+def __admitAll(tasks, submit, results, admission, released):
+    held = list(tasks)
+    while held:
+        for task in list(held):
+            if admission.admit(task[0]):
+                held.remove(task)
+                submit(*task)
+
+        if not held:
+            break
+
+        key = released.get()
+        admission.release(key)
+        result = dict(results)[key]
+        result.wait()
+        if __FailFast and not result.successful():
+            return held
+
+    return held
+
+
+def __applyAll(pool, tasks, cleanup=None, admission=None):
+    done = queue.Queue()
+    released = queue.Queue()
+    results = []
+
+    def submit(key, func, argument, kwargs):
+        def notify(*args):
+            done.put(key)
+            released.put(key)
+
+        results.append((key, pool.apply_async(LogExceptions(func), argument, kwargs,
+                                              callback=notify, error_callback=notify)))
+
+    held = []
+    if admission:
+        held = __admitAll(tasks, submit, results, admission, released)
+    else:
+        for task in tasks:
+            submit(*task)
+
+    if __FailFast:
+        return __waitFailFast(pool, results, done, cleanup, [_[0] for _ in held])
+
+    return __waitAll(pool, results)
+
+
 def doParallel(func, items, *args, **kwargs):
     pool = multiprocessing.Pool(processes=None)
-    results = []
+    tasks = []
 
     try:
-        for item in items:
+        for index, item in enumerate(items):
             if isinstance(item, str):
                 argument = [item] + list(args)
             else:
                 argument = list(item) + list(args)
-            results.append(pool.apply_async(LogExceptions(func), argument, kwargs))
-        pool.close()
-        pool.join()
+            tasks.append((index, func, argument, kwargs))
 
-        for result in results:
-            result.get()
+        __applyAll(pool, tasks)
 
     except (KeyboardInterrupt, Exception):
         pool.terminate()
@@ -42,19 +163,24 @@ def doParallel(func, items, *args, **kwargs):
 
 
 def doPlatformParallel(func, platforms, *args, **kwargs):
-    pool = multiprocessing.Pool(processes=None)
-    results = dict()
-    output = dict()
+    return __doPlatformParallel(func, platforms, None, args, kwargs)
+
+
+# A platform is started only when admission admits it, see memory_admission.MemoryAdmission.
+def doAdmittedPlatformParallel(func, platforms, admission, *args, **kwargs):
+    return __doPlatformParallel(func, platforms, admission, args, kwargs)
+
+
+def __doPlatformParallel(func, platforms, admission, args, kwargs):
+    pool = multiprocessing.Pool(processes=__PoolSize)
+    tasks = []
 
     try:
         for platform in platforms:
             argument = [platform] + list(args)
-            results[platform] = pool.apply_async(LogExceptions(func), argument, kwargs)
-        pool.close()
-        pool.join()
+            tasks.append((platform, func, argument, kwargs))
 
-        for item in results:
-            output[item] = results[item].get()
+        output = __applyAll(pool, tasks, __CancelCleanup, admission)
 
     except (KeyboardInterrupt, Exception):
         pool.terminate()
@@ -66,23 +192,32 @@ def doPlatformParallel(func, platforms, *args, **kwargs):
 
 def parallelDict(dict):
     pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-    results = []
+    tasks = []
     output = []
 
     try:
         for func in dict:
             for item in dict[func]:
-                results.append(pool.apply_async(LogExceptions(func), list(item)))
-        pool.close()
-        pool.join()
+                tasks.append((len(tasks), func, list(item), {}))
 
-        for result in results:
-            ret = result.get()
-            if ret:
-                output.append(ret)
+        results = __applyAll(pool, tasks)
+        for index in range(len(tasks)):
+            if results[index]:
+                output.append(results[index])
     except (KeyboardInterrupt, Exception):
         pool.terminate()
         pool.join()
         raise
 
     return output
+
+
+# A thread per item, at most processes threads if given, e.g. for items each starting a process.
+def doThreadParallel(func, items, processes=None):
+    pool = multiprocessing.pool.ThreadPool(processes=max(min(len(items), processes or len(items)), 1))
+
+    try:
+        return pool.map(LogExceptions(func), items)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,87 @@
+import os
+import hashlib
+import subprocess
+
+import BuildEnv
+from tarball_store import TarballStore
+
+# Build output of projects pinned at a tag, i.e. what their install-dev scripts put into DebDevDir.
+# It only depends on the tag, platform, toolkit version and SynoBuild options, so SynoBuild stages
+# a cached output into the sysroot instead of building the project again.
+#
+# A project is pinned when its checkout is exactly at a tag without local changes. Projects
+# depending on a build project which is not pinned are never cached, their output would
+# follow the changed headers and libraries.
+
+
+def __git(path, *args):
+    with open(os.devnull, 'wb') as null:
+        return subprocess.check_output(['git', '-C', path] + list(args), stderr=null).decode().strip()
+
+
+# (tag, commit) of the checkout, None if it is not exactly at a tag or has changes
+def get_pinned_tag(path):
+    if not os.path.isdir(path):
+        return None
+
+    try:
+        tag = __git(path, 'describe', '--tags', '--exact-match', 'HEAD')
+        commit = __git(path, 'rev-parse', 'HEAD')
+        if __git(path, 'status', '--porcelain', '--untracked-files=no'):
+            return None
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+    return tag, commit
+
+
+class PrebuiltCache:
+    def __init__(self, root, max_size=None):
+        self.store = TarballStore(root, max_size)
+        self.__pins = dict()
+
+    def get_pin(self, proj):
+        path = os.path.join(BuildEnv.SourceDir, BuildEnv.deVirtual(proj))
+        if path not in self.__pins:
+            self.__pins[path] = get_pinned_tag(path)
+
+        return self.__pins[path]
+
+    # cache names of pinned projects whose build depends among projects are all pinned,
+    # options are what else changes the output, e.g. --with-debug or SOURCE_DATE_EPOCH
+    def get_names(self, projects, depends, platform, toolkit_version, options=()):
+        closures = dict()
+
+        def closure(proj, visiting):
+            if proj not in closures:
+                closures[proj] = None
+                deps = set()
+                for dep in depends.get(proj, []):
+                    if dep not in projects or dep in visiting:
+                        continue
+                    dep_closure = closure(dep, visiting | set([proj]))
+                    if dep_closure is None:
+                        return None
+                    deps |= dep_closure | set([dep])
+                closures[proj] = deps if self.get_pin(proj) else None
+
+            return closures[proj]
+
+        names = dict()
+        for proj in sorted(projects):
+            deps = closure(proj, set())
+            if deps is None:
+                continue
+
+            tag, commit = self.get_pin(proj)
+            digest = hashlib.sha1(" ".join([commit] + ["%s:%s" % (_, self.get_pin(_)[1]) for _ in sorted(deps)] +
+                                           list(options)).encode()).hexdigest()
+            names[proj] = "%s@%s@%s@%s-%s.txz" % (proj, tag, platform, toolkit_version, digest[:12])
+
+        return names
+
+    def lookup(self, name):
+        return self.store.lookup(name)
+
+    def insert(self, name, path):
+        return self.store.insert(name, path)
@@ -0,0 +1,89 @@
+import os
+import sys
+import glob
+import atexit
+import pstats
+import cProfile
+import itertools
+
+# Profile the main process and every task run by the pools of parallel.
+# Forked workers write one file per task into the profile dir, the main process writes
+# its own profile at exit, merges all of them into merged.prof and prints the top functions.
+#
+#   python3 -m pstats <profile dir>/merged.prof
+
+TopCount = 30
+
+_profile_dir = None
+_main_pid = None
+_main_profile = None
+_task_count = itertools.count()
+
+
+def enable(profile_dir):
+    global _profile_dir, _main_pid, _main_profile
+
+    os.makedirs(profile_dir, exist_ok=True)
+    for f in glob.glob(os.path.join(profile_dir, '*.prof')):
+        os.remove(f)
+
+    _profile_dir = profile_dir
+    _main_pid = os.getpid()
+    _main_profile = cProfile.Profile()
+    _main_profile.enable()
+    atexit.register(finish)
+
+
+def is_enabled():
+    return _profile_dir is not None
+
+
+# Threads of the main process are covered by the main profile (or not at all before
+# python 3.12), only tasks of forked workers are profiled one by one.
+def run_task(func, *args, **kwargs):
+    global _main_profile
+
+    if not _profile_dir or os.getpid() == _main_pid:
+        return func(*args, **kwargs)
+
+    # the forked copy of the main profile must not collect anything
+    if _main_profile:
+        _main_profile.disable()
+        _main_profile = None
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        name = getattr(func, '__name__', type(func).__name__)
+        profile.dump_stats(os.path.join(_profile_dir, 'task.%d.%d.%s.prof' % (
+            os.getpid(), next(_task_count), name)))
+
+
+def finish():
+    global _main_profile
+
+    if not _main_profile or os.getpid() != _main_pid:
+        return
+
+    _main_profile.disable()
+    _main_profile.dump_stats(os.path.join(_profile_dir, 'main.prof'))
+    _main_profile = None
+
+    files = sorted(glob.glob(os.path.join(_profile_dir, '*.prof')))
+    files.remove(os.path.join(_profile_dir, 'main.prof'))
+    merged = pstats.Stats(os.path.join(_profile_dir, 'main.prof'), stream=sys.stderr)
+    for f in files:
+        try:
+            merged.add(f)
+        except (IOError, OSError, EOFError, TypeError, ValueError):
+            sys.stderr.write("[profile] skip broken profile %s\n" % f)
+
+    merged_file = os.path.join(_profile_dir, 'merged.prof')
+    merged.dump_stats(merged_file)
+
+    with open(os.path.join(_profile_dir, 'summary.txt'), 'w') as fd:
+        pstats.Stats(merged_file, stream=fd).sort_stats('cumulative').print_stats(TopCount)
+
+    sys.stderr.write("[profile] %d task profiles merged into %s\n" % (len(files), merged_file))
+    merged.sort_stats('cumulative').print_stats(TopCount)
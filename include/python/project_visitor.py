@@ -17,6 +17,11 @@ class UpdateHook:
     def __init__(self, *args, **kwargs):
         pass
 
+    @property
+    def checkout_key(self):
+        # Hooks with the same key leave SourceDir in the same state.
+        return None
+
     def update_tag(self, projects):
         pass
 
@@ -34,6 +39,12 @@ class ProjectVisitor:
         self.depends_cache = depends_cache
         self.check_conflict = check_conflict
 
+    @property
+    def resolve_key(self):
+        # Only dynamic variables (kernel, desktop...) make resolution platform dependent.
+        return tuple(frozenset(self.proj_depends.get_dyn_sec_values(var, self.platforms))
+                     for var in self.proj_depends.dynamic_variables)
+
     def devirtual_all(self, projs):
         return set(map(BuildEnv.deVirtual, projs))
 
@@ -0,0 +1,65 @@
+import os
+import io
+import hashlib
+import tarfile
+import subprocess
+
+# Reproducible build helpers. Builds get SOURCE_DATE_EPOCH, include/codec creates tarballs
+# with sorted entries, that mtime and root owners, so the same sources give the same spk.
+
+InnerArchives = ('.tgz', '.txz', '.tar', '.tar.gz', '.tar.xz')
+
+
+# commit time of the newest source, SOURCE_DATE_EPOCH of the environment wins
+def get_source_date_epoch(source_dirs):
+    if os.environ.get('SOURCE_DATE_EPOCH'):
+        return int(os.environ['SOURCE_DATE_EPOCH'])
+
+    epochs = []
+    for path in source_dirs:
+        try:
+            with open(os.devnull, 'wb') as null:
+                output = subprocess.check_output(['git', '-C', path, 'log', '-1', '--format=%ct'], stderr=null)
+        except (subprocess.CalledProcessError, OSError):
+            continue
+        if output.strip():
+            epochs.append(int(output))
+
+    return max(epochs) if epochs else None
+
+
+def __digest_tar(fileobj, prefix, digests):
+    with tarfile.open(fileobj=fileobj, mode='r:*') as tar:
+        for member in tar:
+            name = prefix + member.name
+            meta = "%o %d %d %s %s %d %s" % (member.mode, member.uid, member.gid, member.uname, member.gname,
+                                            member.mtime, member.linkname)
+            digest = hashlib.sha1(meta.encode())
+            if member.isfile():
+                data = tar.extractfile(member).read()
+                digest.update(data)
+                if name.endswith(InnerArchives):
+                    try:
+                        __digest_tar(io.BytesIO(data), name + '/', digests)
+                    except tarfile.TarError:
+                        pass
+            digests[name] = digest.hexdigest()
+
+
+# digests of the archive and its members, members of inner tarballs are named <tarball>/<member>
+def digest_archive(path):
+    digests = dict()
+    with open(path, 'rb') as fd:
+        digests[''] = hashlib.sha256(fd.read()).hexdigest()
+        fd.seek(0)
+        try:
+            __digest_tar(fd, '', digests)
+        except tarfile.TarError:
+            pass
+
+    return digests
+
+
+# members differing between two digest_archive() results, the archive itself is ''
+def diff_digests(first, second):
+    return sorted(_ for _ in set(first) | set(second) if first.get(_) != second.get(_))
@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+
+PageSize = os.sysconf('SC_PAGE_SIZE')
+ClockTicks = os.sysconf('SC_CLK_TCK')
+
+
+def read_process_stat(pid):
+    with open('/proc/%d/stat' % pid, 'r') as fd:
+        stat = fd.read()
+
+    # comm may contain spaces, fields are counted after its closing parenthesis
+    fields = stat[stat.rindex(')') + 2:].split()
+    return {
+        'ppid': int(fields[1]),
+        'majflt': int(fields[9]),
+        'cmajflt': int(fields[10]),
+        'cpu': (int(fields[11]) + int(fields[12])) / float(ClockTicks),
+        'ccpu': (int(fields[13]) + int(fields[14])) / float(ClockTicks),
+        'starttime': int(fields[19]),
+        'rss': int(fields[21]) * PageSize,
+    }
+
+
+def read_process_io(pid):
+    io = {'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open('/proc/%d/io' % pid, 'r') as fd:
+            for line in fd:
+                key, value = line.split(':')
+                if key in io:
+                    io[key] = int(value)
+    except (IOError, OSError):
+        pass
+
+    return io
+
+
+def get_process_tree(root_pid):
+    stats = dict()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            stats[int(pid)] = read_process_stat(int(pid))
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+
+    children = dict()
+    for pid, stat in stats.items():
+        children.setdefault(stat['ppid'], []).append(pid)
+
+    tree = dict()
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        if pid in stats:
+            tree[pid] = stats[pid]
+            pending += children.get(pid, [])
+
+    return tree
+
+
+def read_cmdline(pid):
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as fd:
+            return fd.read().decode(errors='replace').rstrip('\0').split('\0')
+    except (IOError, OSError):
+        return ['']
+
+
+# SynoBuild and SynoInstall pipe the output of each project into "tee logs/<proj>.<type>",
+# proj -> pid of its tee. The tee of the whole run writes logs.<type> outside logs/.
+def get_running_projects(tree, log_type):
+    suffix = '.' + log_type
+    running = dict()
+    for pid in tree:
+        cmdline = read_cmdline(pid)
+        if os.path.basename(cmdline[0]) != 'tee' or not cmdline[-1].endswith(suffix) or \
+                os.path.basename(os.path.dirname(cmdline[-1])) != 'logs':
+            continue
+        running[os.path.basename(cmdline[-1])[:-len(suffix)]] = pid
+
+    return running
+
+
+# Sample CPU, RSS, I/O and major faults of a process and all its descendants from /proc.
+# A process exited and waited for is accounted to its parent: cutime/cstime and cmajflt of the
+# parent, and /proc/<pid>/io of the parent includes its reaped children. So counters are the sum of
+# the cumulative counters of the processes alive at a sample, short compilers between two samples
+# are counted by their make, none is counted twice.
+# With log_type, the RSS of the whole tree is also accounted to the projects running at the sample.
+class ResourceSampler(threading.Thread):
+    Columns = ['time', 'cpu', 'rss', 'read_bytes', 'write_bytes', 'majflt']
+
+    def __init__(self, pid, interval, log_type=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.log_type = log_type
+        self.samples = []
+        self.project_rss = dict()
+        self.__stop_event = threading.Event()
+        self.__start_time = time.time()
+
+    def __enter__(self):
+        if self.interval > 0:
+            self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.interval > 0:
+            self.__stop_event.set()
+            self.join()
+
+    def run(self):
+        while True:
+            self.sample()
+            if self.__stop_event.wait(self.interval):
+                break
+
+    def sample(self):
+        tree = get_process_tree(self.pid)
+        # the root has exited, its counters are gone with it
+        if self.pid not in tree:
+            return
+
+        sample = {'time': time.time() - self.__start_time, 'rss': 0, 'cpu': 0, 'read_bytes': 0,
+                  'write_bytes': 0, 'majflt': 0}
+        for pid, stat in tree.items():
+            sample['rss'] += stat['rss']
+            sample['cpu'] += stat['cpu'] + stat['ccpu']
+            sample['majflt'] += stat['majflt'] + stat['cmajflt']
+            for key, value in read_process_io(pid).items():
+                sample[key] += value
+
+        if self.log_type:
+            for proj in get_running_projects(tree, self.log_type):
+                self.project_rss[proj] = max(self.project_rss.get(proj, 0), sample['rss'])
+
+        # an orphan reparented out of the tree takes its counters along
+        if self.samples:
+            for key in ['cpu', 'read_bytes', 'write_bytes', 'majflt']:
+                sample[key] = max(sample[key], self.samples[-1][key])
+        self.samples.append(sample)
+
+    def write_series(self, path):
+        with open(path, 'w') as fd:
+            fd.write("\t".join(self.Columns) + "\n")
+            for sample in self.samples:
+                fd.write("\t".join("%.2f" % sample[_] if _ in ['time', 'cpu'] else str(sample[_])
+                                   for _ in self.Columns) + "\n")
+
+    # cpu is the number of busy cores between two samples
+    def summary(self):
+        if not self.samples:
+            return None
+
+        cpu = []
+        for prev, curr in zip(self.samples, self.samples[1:]):
+            if curr['time'] > prev['time']:
+                cpu.append((curr['cpu'] - prev['cpu']) / (curr['time'] - prev['time']))
+
+        last = self.samples[-1]
+        rss = [_['rss'] for _ in self.samples]
+        return {
+            'cpu_avg': last['cpu'] / last['time'] if last['time'] else 0,
+            'cpu_peak': max(cpu) if cpu else 0,
+            'rss_avg': sum(rss) / len(rss),
+            'rss_peak': max(rss),
+            'read_bytes': last['read_bytes'],
+            'write_bytes': last['write_bytes'],
+            'majflt': last['majflt'],
+            'project_rss_peak': dict(self.project_rss),
+        }
+
+
+def format_size(size):
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            return "%.0f%s" % (size, unit)
+        size /= 1024.0
+
+    return "%.1fT" % size
+
+
+def format_usage(summary):
+    if not summary:
+        return "no sample"
+
+    return "cpu avg %.1f peak %.1f, rss avg %s peak %s, read %s, write %s, majflt %d" % (
+        summary['cpu_avg'], summary['cpu_peak'], format_size(summary['rss_avg']), format_size(summary['rss_peak']),
+        format_size(summary['read_bytes']), format_size(summary['write_bytes']), summary['majflt'])
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+
+# Stage files installed by install-dev scripts into the toolchain sysroot.
+# Files staged by each project are recorded in a manifest under the sysroot, so a rebuilt
+# project only rewrites files which changed and its files which are gone are removed.
+#
+#   sysroot_stage.py stage <project> <install dir> <sysroot>
+#   sysroot_stage.py remove <project> <sysroot>
+#   sysroot_stage.py owner <sysroot> <path>...
+
+ManifestDir = '.pkgscripts/manifests'
+
+# libtool archives contain absolute paths of the build env, linking without them works fine
+SkipSuffix = ['.la']
+
+
+class SysrootStageError(RuntimeError):
+    pass
+
+
+def get_manifest_path(sysroot, proj):
+    return os.path.join(sysroot, ManifestDir, proj + '.json')
+
+
+def read_manifest(sysroot, proj):
+    path = get_manifest_path(sysroot, proj)
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path, 'r') as fd:
+        return json.load(fd)
+
+
+def write_manifest(sysroot, proj, manifest):
+    path = get_manifest_path(sysroot, proj)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, path)
+
+
+def list_manifests(sysroot):
+    manifest_dir = os.path.join(sysroot, ManifestDir)
+    if not os.path.isdir(manifest_dir):
+        return []
+
+    return sorted(f[:-len('.json')] for f in os.listdir(manifest_dir) if f.endswith('.json'))
+
+
+# pkg-config files must not point into the sysroot, the compiler adds it by --sysroot
+def read_source(path, sysroot):
+    with open(path, 'rb') as fd:
+        content = fd.read()
+
+    if path.endswith('.pc') and sysroot:
+        content = content.replace(sysroot.encode(), b'')
+
+    return content
+
+
+def is_unchanged(dest, entry, digest):
+    if not entry or entry.get('digest') != digest:
+        return False
+
+    try:
+        stat = os.lstat(dest)
+    except OSError:
+        return False
+
+    # another project may have overwritten the file since
+    return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+
+def write_file(dest, content, mode):
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        raise SysrootStageError("%s is a directory" % dest)
+
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.stage.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, dest)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def write_link(dest, target):
+    if os.path.islink(dest) and os.readlink(dest) == target:
+        return False
+
+    if os.path.lexists(dest):
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            raise SysrootStageError("%s is a directory" % dest)
+        os.remove(dest)
+    os.symlink(target, dest)
+    return True
+
+
+def walk_install_dir(install_dir):
+    for dirpath, dirs, files in os.walk(install_dir):
+        dirs.sort()
+        for name in sorted(files + [d for d in dirs if os.path.islink(os.path.join(dirpath, d))]):
+            path = os.path.join(dirpath, name)
+            if any(name.endswith(_) for _ in SkipSuffix):
+                continue
+            yield os.path.relpath(path, install_dir), path
+
+
+def remove_files(sysroot, files, keep=()):
+    removed = 0
+    dirs = set()
+    for rel in files:
+        if rel in keep:
+            continue
+
+        dest = os.path.join(sysroot, rel)
+        if os.path.lexists(dest) and not (os.path.isdir(dest) and not os.path.islink(dest)):
+            os.remove(dest)
+            removed += 1
+        dirs.add(os.path.dirname(dest))
+
+    # remove directories left empty, deepest first
+    for d in sorted(dirs, key=len, reverse=True):
+        while d.startswith(sysroot + '/'):
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+            d = os.path.dirname(d)
+
+    return removed
+
+
+def get_other_owned(sysroot, proj):
+    owned = set()
+    for other in list_manifests(sysroot):
+        if other != proj:
+            owned.update(read_manifest(sysroot, other).keys())
+
+    return owned
+
+
+def stage(proj, install_dir, sysroot):
+    pc_sysroot = sysroot
+    sysroot = os.path.normpath(sysroot)
+    old_manifest = read_manifest(sysroot, proj)
+    manifest = dict()
+    copied = 0
+    unchanged = 0
+
+    if os.path.isdir(install_dir):
+        for rel, path in walk_install_dir(install_dir):
+            dest = os.path.join(sysroot, rel)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+            if os.path.islink(path):
+                if write_link(dest, os.readlink(path)):
+                    copied += 1
+                else:
+                    unchanged += 1
+                manifest[rel] = {'link': os.readlink(path)}
+                continue
+
+            content = read_source(path, pc_sysroot)
+            digest = hashlib.sha256(content).hexdigest()
+            if is_unchanged(dest, old_manifest.get(rel), digest):
+                manifest[rel] = old_manifest[rel]
+                unchanged += 1
+                continue
+
+            write_file(dest, content, os.stat(path).st_mode & 0o7777)
+            stat = os.lstat(dest)
+            manifest[rel] = {'digest': digest, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            copied += 1
+
+    stale = set(old_manifest) - set(manifest)
+    removed = 0
+    if stale:
+        removed = remove_files(sysroot, stale, keep=get_other_owned(sysroot, proj))
+
+    write_manifest(sysroot, proj, manifest)
+    print("Stage %s: %d copied, %d unchanged, %d removed." % (proj, copied, unchanged, removed))
+
+
+def remove(proj, sysroot):
+    sysroot = os.path.normpath(sysroot)
+    manifest = read_manifest(sysroot, proj)
+    removed = remove_files(sysroot, manifest, keep=get_other_owned(sysroot, proj))
+    path = get_manifest_path(sysroot, proj)
+    if os.path.isfile(path):
+        os.remove(path)
+    print("Remove %s: %d removed." % (proj, removed))
+
+
+def owner(sysroot, paths):
+    sysroot = os.path.normpath(sysroot)
+    manifests = dict((proj, read_manifest(sysroot, proj)) for proj in list_manifests(sysroot))
+    for path in paths:
+        rel = os.path.relpath(os.path.abspath(path), sysroot) if os.path.isabs(path) else path
+        owners = [proj for proj, manifest in manifests.items() if rel in manifest]
+        print("%s: %s" % (path, " ".join(owners) if owners else "not staged"))
+
+
+def parse_args(argv):
+    argparser = argparse.ArgumentParser(description='Stage install-dev files into the toolchain sysroot.')
+    subparsers = argparser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser = subparsers.add_parser('stage', help='Stage files of a project, replacing its previous files.')
+    parser.add_argument('project')
+    parser.add_argument('install_dir')
+    parser.add_argument('sysroot')
+
+    parser = subparsers.add_parser('remove', help='Remove all files staged by a project.')
+    parser.add_argument('project')
+    parser.add_argument('sysroot')
+
+    parser = subparsers.add_parser('owner', help='Show which project staged the files.')
+    parser.add_argument('sysroot')
+    parser.add_argument('paths', nargs='+')
+
+    return argparser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.command == 'stage':
+        stage(args.project, args.install_dir, args.sysroot)
+    elif args.command == 'remove':
+        remove(args.project, args.sysroot)
+    else:
+        owner(args.sysroot, args.paths)
+
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except (SysrootStageError, OSError) as e:
+        print("[ERROR] " + str(e), file=sys.stderr)
+        sys.exit(1)
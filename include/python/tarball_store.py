@@ -0,0 +1,171 @@
+import os
+import json
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+# Blobs are stored by sha256 under blobs/, index.json maps tarball name to digest.
+# Files are written to tmp/ and renamed into place, so readers on other hosts
+# never see a partial blob or index. Last use is tracked by blob mtime.
+# Blobs looked up or inserted by this process are pinned until release(), so
+# eviction never removes a tarball the current run has yet to extract.
+
+
+class TarballStoreError(RuntimeError):
+    pass
+
+
+class TarballStore:
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+        self.__pinned = set()
+        for path in [self.blob_dir, self.tmp_dir]:
+            os.makedirs(path, exist_ok=True)
+
+    @property
+    def blob_dir(self):
+        return os.path.join(self.root, 'blobs')
+
+    @property
+    def tmp_dir(self):
+        return os.path.join(self.root, 'tmp')
+
+    @property
+    def index_file(self):
+        return os.path.join(self.root, 'index.json')
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    @contextmanager
+    def __lock(self):
+        with open(os.path.join(self.root, '.lock'), 'a') as fd:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    def __read_index(self):
+        if not os.path.isfile(self.index_file):
+            return {}
+
+        with open(self.index_file, 'r') as fd:
+            return json.load(fd)
+
+    def __write_index(self, index):
+        fd, tmp_file = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.index_file)
+
+    def lookup(self, name):
+        entry = self.__read_index().get(name)
+        if not entry:
+            return None
+
+        blob = self.get_blob_path(entry['digest'])
+        if not os.path.isfile(blob):
+            return None
+
+        try:
+            os.utime(blob)
+        except OSError:
+            # evicted by another host meanwhile, or a read-only store
+            if not os.path.isfile(blob):
+                return None
+
+        self.__pinned.add(entry['digest'])
+        return blob
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def insert(self, name, src):
+        digest = hashlib.sha256()
+        fd, tmp_file = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as dest, open(src, 'rb') as source:
+                for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                    dest.write(chunk)
+                dest.flush()
+                os.fsync(dest.fileno())
+
+            digest = digest.hexdigest()
+            blob = self.get_blob_path(digest)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            self.__pinned.add(digest)
+            if os.path.isfile(blob):
+                os.remove(tmp_file)
+                os.utime(blob)
+            else:
+                os.chmod(tmp_file, 0o644)
+                os.rename(tmp_file, blob)
+        except (IOError, OSError) as e:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise TarballStoreError("Failed to insert %s: %s" % (src, e))
+
+        with self.__lock():
+            index = self.__read_index()
+            index[name] = {'digest': digest, 'size': os.path.getsize(blob)}
+            self.__write_index(index)
+
+        print("Store %s -> %s" % (name, digest))
+        self.evict()
+        return blob
+
+    def import_dir(self, mirror):
+        imported = []
+        for dirpath, _, files in os.walk(mirror):
+            for f in sorted(files):
+                if f.endswith('.txz') or '.tar' in f:
+                    self.insert(f, os.path.join(dirpath, f))
+                    imported.append(f)
+
+        return imported
+
+    # pinned blobs may be evicted once the run is done with them
+    def release(self):
+        self.__pinned.clear()
+        self.evict()
+
+    # least recently used blobs are removed until the store fits into max_size
+    def evict(self):
+        if not self.max_size:
+            return
+
+        blobs = []
+        for dirpath, _, files in os.walk(self.blob_dir):
+            for f in files:
+                try:
+                    stat = os.stat(os.path.join(dirpath, f))
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, f))
+
+        total = sum(_[1] for _ in blobs)
+        if total <= self.max_size:
+            return
+
+        with self.__lock():
+            removed = set()
+            for _, size, digest in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                if digest in self.__pinned:
+                    continue
+                print("Evict " + digest)
+                try:
+                    os.remove(self.get_blob_path(digest))
+                except FileNotFoundError:
+                    pass
+                removed.add(digest)
+                total -= size
+
+            index = self.__read_index()
+            self.__write_index(dict((name, entry) for name, entry in index.items()
+                                    if entry['digest'] not in removed))
@@ -0,0 +1,119 @@
+import os
+import re
+import sqlite3
+import time
+
+# Only the latest runs are relevant for prediction.
+HistorySize = 5
+
+
+class TimingDatabase:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stage_time '
+                          '(package TEXT, platform TEXT, stage TEXT, seconds REAL, created REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS project_time '
+                          '(platform TEXT, project TEXT, phase TEXT, seconds REAL, created REAL)')
+        # project is '' for the whole stage
+        self.conn.execute('CREATE TABLE IF NOT EXISTS peak_rss '
+                          '(platform TEXT, stage TEXT, project TEXT, bytes INTEGER, created REAL)')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def add_stage_time(self, package, platform, stage, seconds):
+        self.conn.execute('INSERT INTO stage_time VALUES (?, ?, ?, ?, ?)',
+                          (package, platform, stage, seconds, time.time()))
+
+    def add_project_time(self, platform, project, phase, seconds):
+        self.conn.execute('INSERT INTO project_time VALUES (?, ?, ?, ?, ?)',
+                          (platform, project, phase, seconds, time.time()))
+
+    def add_peak_rss(self, platform, stage, project, rss):
+        self.conn.execute('INSERT INTO peak_rss VALUES (?, ?, ?, ?, ?)',
+                          (platform, stage, project, rss, time.time()))
+
+    def __latest(self, query, args):
+        return [_[0] for _ in self.conn.execute(query + ' ORDER BY created DESC LIMIT %d' % HistorySize,
+                                                args).fetchall()]
+
+    def __average(self, query, args):
+        rows = self.__latest(query, args)
+        if not rows:
+            return None
+        return sum(rows) / len(rows)
+
+    def get_stage_time(self, package, platform, stage):
+        return self.__average('SELECT seconds FROM stage_time WHERE package=? AND platform=? AND stage=?',
+                              (package, platform, stage))
+
+    def get_project_time(self, platform, project, phase='build'):
+        return self.__average('SELECT seconds FROM project_time WHERE platform=? AND project=? AND phase=?',
+                              (platform, project, phase))
+
+    # memory is reserved for the worst of the latest runs
+    def get_peak_rss(self, platform, stage, project=''):
+        rows = self.__latest('SELECT bytes FROM peak_rss WHERE platform=? AND stage=? AND project=?',
+                             (platform, stage, project))
+        return max(rows) if rows else None
+
+
+# "Time cost: 00:01:02 [Build-->proj]" written by ShowTimeCost of include/check
+def parse_time_cost(log):
+    if not os.path.isfile(log):
+        return None
+
+    with open(log, 'r', errors='replace') as fd:
+        for line in fd:
+            match = re.search(r'Time cost: (\d+):(\d+):(\d+)', line)
+            if match:
+                hour, minute, second = map(int, match.groups())
+                return hour * 3600 + minute * 60 + second
+
+    return None
+
+
+# Priority of a project is its own duration plus the longest chain of projects depending on it.
+# depends: project -> projects it depends on
+def critical_path_order(projects, depends, durations):
+    dependents = dict((proj, set()) for proj in projects)
+    for proj in projects:
+        for dep in depends.get(proj, []):
+            if dep in dependents and dep != proj:
+                dependents[dep].add(proj)
+
+    priority = dict()
+
+    def get_priority(proj, stack):
+        if proj not in priority:
+            longest = 0
+            for dependent in dependents[proj]:
+                if dependent not in stack:
+                    longest = max(longest, get_priority(dependent, stack | {proj}))
+            priority[proj] = (durations.get(proj) or 0) + longest
+        return priority[proj]
+
+    return sorted(projects, key=lambda proj: (-get_priority(proj, frozenset()), proj))
+
+
+# Longest processing time first on a pool of workers, unknown durations are started first.
+def lpt_order(durations):
+    return sorted(durations, key=lambda item: (durations[item] is not None, -(durations[item] or 0), item))
+
+
+def predict_makespan(durations, workers):
+    loads = [0] * max(workers, 1)
+    for item in lpt_order(durations):
+        index = loads.index(min(loads))
+        loads[index] += durations[item] or 0
+
+    return max(loads)
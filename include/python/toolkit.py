@@ -6,22 +6,50 @@ class TarballManager:
         self.version = version
         self.root = root
 
+    def get_tarball_path(self, name):
+        return os.path.join(self.root, name)
+
+    # tarballs which are available without download
+    def has_tarball(self, name):
+        return False
+
+    # downloaded tarball is kept in root
+    def add_tarball(self, path):
+        pass
+
     @property
     def base_tarball_name(self):
         return 'base_env-%s.txz' % self.version
 
     @property
     def base_tarball_path(self):
-        return os.path.join(self.root, self.base_tarball_name)
+        return self.get_tarball_path(self.base_tarball_name)
 
     def get_env_tarball_name(self, platform):
         return 'ds.%s-%s.env.txz' % (platform, self.version)
 
     def get_env_tarball_path(self, platform):
-        return os.path.join(self.root, self.get_env_tarball_name(platform))
+        return self.get_tarball_path(self.get_env_tarball_name(platform))
 
     def get_dev_tarball_name(self, platform):
         return 'ds.%s-%s.dev.txz' % (platform, self.version)
 
     def get_dev_tarball_path(self, platform):
-        return os.path.join(self.root, self.get_dev_tarball_name(platform))
+        return self.get_tarball_path(self.get_dev_tarball_name(platform))
+
+
+# Resolve tarballs from a TarballStore first, downloaded tarballs are moved into the store.
+class StoreTarballManager(TarballManager):
+    def __init__(self, version, root, store):
+        TarballManager.__init__(self, version, root)
+        self.store = store
+
+    def get_tarball_path(self, name):
+        return self.store.lookup(name) or TarballManager.get_tarball_path(self, name)
+
+    def has_tarball(self, name):
+        return name in self.store
+
+    def add_tarball(self, path):
+        self.store.insert(os.path.basename(path), path)
+        os.remove(path)
@@ -0,0 +1,226 @@
+import os
+import signal
+import threading
+import time
+
+from resource_usage import get_process_tree, get_running_projects, read_cmdline, ClockTicks
+
+# Watchdog of a SynoBuild/SynoInstall run inside the chroot.
+# A running project is told by its tee (see get_running_projects) and its processes by
+# writing into the pipe of that tee. A project exceeding its timeout gets its process tree
+# and wait channels dumped into logs/<proj>.<type>.hang, is killed and an Error line is
+# appended to its log, so CheckErrorLog reports it and the run goes on with the next project.
+# A run exceeding the stage timeout is killed as a whole, running projects are marked
+# failed in logs.<type>, the log of the whole run written by PkgCreate.
+
+LogDir = 'logs'
+
+
+class Timeouts:
+    def __init__(self, log_type, stage=None, projects=None, default_project=None):
+        self.log_type = log_type
+        self.stage = stage
+        self.projects = projects or dict()
+        self.default_project = default_project
+
+    def get_project(self, proj):
+        return self.projects.get(proj, self.default_project)
+
+    def __bool__(self):
+        return bool(self.stage or self.projects or self.default_project)
+
+
+# timeout is factor times the average of previous runs, but not less than minimum
+class TimeoutPolicy:
+    def __init__(self, factor=4.0, minimum=1800, stage=None, project=None):
+        self.factor = factor
+        self.minimum = minimum
+        self.stage = stage
+        self.project = project
+
+    def get_timeout(self, history, fixed=None):
+        if fixed:
+            return fixed
+        if not self.factor or history is None:
+            return None
+
+        return max(history * self.factor, self.minimum)
+
+    # projects run one after another, so a stage running projects is bound by their sum. The average
+    # of the stage mixes runs of other projects, e.g. --changed builds, and is only used without them.
+    def get_timeouts(self, log_type, stage_history, project_histories):
+        if project_histories:
+            histories = list(project_histories.values())
+            stage_history = sum(histories) if None not in histories else None
+
+        projects = dict((proj, self.get_timeout(history, self.project))
+                        for proj, history in project_histories.items())
+        return Timeouts(log_type, self.get_timeout(stage_history, self.stage),
+                        dict((k, v) for k, v in projects.items() if v), self.project)
+
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as fd:
+            return fd.read().decode(errors='replace')
+    except (IOError, OSError):
+        return ''
+
+
+def read_fd(pid, fd):
+    try:
+        return os.readlink('/proc/%d/fd/%d' % (pid, fd))
+    except OSError:
+        return None
+
+
+def format_process_tree(tree):
+    lines = ["%7s %7s %5s %-24s %s" % ('PID', 'PPID', 'STATE', 'WCHAN', 'COMMAND')]
+    for pid in sorted(tree):
+        stat = read_file('/proc/%d/stat' % pid)
+        state = stat[stat.rindex(')') + 2:].split()[0] if ')' in stat else '?'
+        lines.append("%7d %7d %5s %-24s %s" % (pid, tree[pid]['ppid'], state,
+                                               read_file('/proc/%d/wchan' % pid) or '-',
+                                               " ".join(read_cmdline(pid))))
+
+    # kernel stacks are only readable by root
+    for pid in sorted(tree):
+        stack = read_file('/proc/%d/stack' % pid).strip()
+        if stack:
+            lines += ["", "[%d] stack:" % pid] + stack.split("\n")
+
+    return "\n".join(lines) + "\n"
+
+
+def get_boot_time():
+    for line in read_file('/proc/stat').split("\n"):
+        if line.startswith('btime '):
+            return int(line.split()[1])
+
+    return 0
+
+
+def is_alive(pid):
+    stat = read_file('/proc/%d/stat' % pid)
+    return bool(stat) and not stat[stat.rindex(')') + 2:].startswith('Z')
+
+
+def wait_exit(pid, timeout):
+    deadline = time.time() + timeout
+    while is_alive(pid):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.1)
+
+    return True
+
+
+def kill_processes(pids, timeout=10):
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        alive = []
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+                alive.append(pid)
+            except OSError:
+                pass
+
+        deadline = time.time() + timeout
+        while alive and time.time() < deadline:
+            time.sleep(0.1)
+            alive = [_ for _ in alive if is_alive(_)]
+
+        if not alive:
+            return
+        pids = alive
+
+
+class Watchdog(threading.Thread):
+    def __init__(self, pid, timeouts, interval=5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.timeouts = timeouts
+        self.stage_log = 'logs.' + timeouts.log_type if timeouts else None
+        self.interval = interval
+        self.expired = []
+        self.stage_expired = False
+        self.__started = dict()
+        self.__stop_event = threading.Event()
+        self.__start_time = time.time()
+        self.__boot_time = get_boot_time()
+
+    def __enter__(self):
+        if self.timeouts:
+            self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timeouts:
+            self.__stop_event.set()
+            self.join()
+
+    def run(self):
+        while not self.__stop_event.wait(self.interval):
+            self.check()
+
+    def check(self):
+        now = time.time()
+        tree = get_process_tree(self.pid)
+        running = get_running_projects(tree, self.timeouts.log_type)
+        # a project starts with its tee
+        for proj, tee in running.items():
+            self.__started.setdefault(proj, max(self.__boot_time + tree[tee]['starttime'] / float(ClockTicks),
+                                                self.__start_time))
+
+        if self.timeouts.stage and now - self.__start_time > self.timeouts.stage:
+            self.stage_expired = True
+            messages = [self.__dump(proj, tree, now - self.__started[proj], self.timeouts.stage)
+                        for proj in running]
+            if not running:
+                with open(os.path.join(LogDir, 'stage.%s.hang' % self.timeouts.log_type), 'w') as fd:
+                    fd.write(format_process_tree(tree))
+            print("[WATCHDOG] Stage timeout after %ds, kill %d processes." % (self.timeouts.stage, len(tree)))
+            kill_processes(sorted(tree))
+
+            # the run is killed before CheckErrorLog reports the projects
+            for proj, message in zip(running, messages):
+                self.__mark_failed(proj, message)
+                if self.stage_log:
+                    with open(self.stage_log, 'a') as fd:
+                        fd.write('      Error(s) occurred on project "%s"\n' % proj)
+            self.__stop_event.set()
+            return
+
+        for proj, tee in running.items():
+            timeout = self.timeouts.get_project(proj)
+            elapsed = now - self.__started[proj]
+            if not timeout or elapsed <= timeout or proj in self.expired:
+                continue
+
+            pipe = read_fd(tee, 0)
+            victims = dict()
+            for pid in tree:
+                if pid != tee and read_fd(pid, 1) == pipe:
+                    victims.update(get_process_tree(pid))
+            message = self.__dump(proj, victims, elapsed, timeout)
+            kill_processes(sorted(victims))
+
+            # tee does not append, it must be gone before the log is written
+            kill_processes([tee] if not wait_exit(tee, 10) else [])
+            self.__mark_failed(proj, message)
+
+    def __dump(self, proj, tree, elapsed, timeout):
+        self.expired.append(proj)
+        hang_log = os.path.join(LogDir, '%s.%s.hang' % (proj, self.timeouts.log_type))
+        with open(hang_log, 'w') as fd:
+            fd.write(format_process_tree(tree))
+
+        message = "Error: watchdog killed %s after %ds, timeout %ds, processes are dumped into %s" % (
+            proj, elapsed, timeout, hang_log)
+        print("[WATCHDOG] " + message)
+        return message
+
+    def __mark_failed(self, proj, message):
+        with open(os.path.join(LogDir, '%s.%s' % (proj, self.timeouts.log_type)), 'a') as fd:
+            fd.write(message + "\n")